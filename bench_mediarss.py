@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# Compares mediarss.extract_thumbnails with the BeautifulSoup code it replaced
+# on generated entry bodies of increasing size:
+#
+#   python bench_mediarss.py [repeat]
+
+import BeautifulSoup
+import mediarss
+import sys
+import timeit
+
+
+def soup_thumbnails(body):
+    soup = BeautifulSoup.BeautifulSoup(body,
+        parseOnlyThese=BeautifulSoup.SoupStrainer("img"))
+    imgs = soup.findAll("img")
+    thumbnails = []
+    for img in imgs:
+        if "nomediarss" in img.get("class", "").split():
+            continue
+        thumbnails.append({
+            "url": img["src"],
+            "title": img.get("title", img.get("alt", "")),
+            "width": img.get("width", ""),
+            "height": img.get("height", ""),
+        })
+    return thumbnails
+
+
+PARAGRAPH = u"""
+<p>Lorem ipsum <a href="http://example.com/%(i)d">dolor</a> sit amet,
+<em>consectetur</em> adipiscing elit. <code>if (a &lt; b) { b = a; }</code></p>
+<p><img src="http://example.com/%(i)d.jpg" alt="Photo %(i)d" width="500"
+height="375"/></p>
+<!-- <img src="http://example.com/commented-out.jpg"/> -->
+<p><img class="left nomediarss" src="http://example.com/icon.png"/>
+<IMG SRC='http://example.com/%(i)d-upper.png' TITLE='Upper %(i)d'></p>
+<pre>for (i = 0; i &lt; n; i++) { total += i; }</pre>
+"""
+
+
+def make_body(paragraphs):
+    return u"".join(PARAGRAPH % {"i": i} for i in xrange(paragraphs))
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    for paragraphs in (1, 10, 100, 1000):
+        body = make_body(paragraphs)
+        expected = soup_thumbnails(body)
+        actual = mediarss.extract_thumbnails(body)
+        assert actual == expected, (actual[:2], expected[:2])
+        soup = min(timeit.repeat(lambda: soup_thumbnails(body),
+                                 repeat=3, number=repeat)) / repeat
+        fast = min(timeit.repeat(lambda: mediarss.extract_thumbnails(body),
+                                 repeat=3, number=repeat)) / repeat
+        print "%6d bytes %4d images  soup %9.3fms  mediarss %8.3fms  %5.1fx" % (
+            len(body), len(expected), soup * 1000, fast * 1000, soup / fast)
+
+
+if __name__ == "__main__":
+    main()
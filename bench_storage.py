@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# Times the storage operations the handlers use against a backend filled with
+# generated entries:
+#
+#   python bench_storage.py [storage url] [entries]
+#
+# The url is the same as BLOG_STORAGE and defaults to a temporary SQLite
+# database. The datastore backend needs the App Engine SDK on the path (e.g.
+# from a remote_api shell) and the models from models.py.
+
+import entryindex
+import os
+import random
+import storage
+import sys
+import tempfile
+import timeit
+
+
+def populate(backend, count):
+    tags = ["tag%d" % i for i in xrange(20)]
+    entries = []
+    for i in xrange(count):
+        entry = backend.new(author="bench", title=u"Entry %d" % i,
+                            slug="entry-%d" % i, body=u"<p>Body</p>" * 200)
+        backend.update(entry, tags=random.sample(tags, 3), hidden=i % 10 == 0,
+                       thumbnails=[])
+        entries.append(entry)
+    backend.put_multi(entries)
+
+
+def bench(name, function, number=200):
+    seconds = min(timeit.repeat(function, repeat=3, number=number)) / number
+    print "%-28s %8.3fms" % (name, seconds * 1000)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1]:
+        url = sys.argv[1]
+    else:
+        url = "sqlite:" + os.path.join(tempfile.mkdtemp(), "bench.db")
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    models = ()
+    if not url.startswith("sqlite:"):
+        import models
+        models = (models.Entry, models.Tag, models.EntrySummary)
+    backend = storage.from_url(url, *models)
+    populate(backend, count)
+    (first, cursor) = backend.list_visible(10)
+    slugs = ["entry-%d" % random.randrange(count) for i in xrange(100)]
+    bench("get_by_slug", lambda: backend.get_by_slug(random.choice(slugs)))
+    bench("get", lambda: backend.get(first[0].key()))
+    bench("list_visible(5)", lambda: backend.list_visible(5))
+    bench("list_visible(10, cursor)", lambda: backend.list_visible(10, cursor))
+    bench("list_by_tag(10)", lambda: backend.list_by_tag("tag1", 10))
+    bench("list_by_tag(all)", lambda: backend.list_by_tag("tag1"), number=20)
+    bench("metadata", backend.metadata, number=5)
+    index = entryindex.EntryIndex(backend.metadata())
+    bench("index build", lambda: entryindex.EntryIndex(index.rows()), number=5)
+    (records, cursor) = index.list_visible(10)
+    bench("index list_visible(10)", lambda: index.list_visible(10, cursor))
+    bench("index list_by_tag(10)", lambda: index.list_by_tag("tag1", 10))
+    bench("get_multi(10)",
+          lambda: backend.get_multi([record.key for record in records]))
+
+
+if __name__ == "__main__":
+    main()
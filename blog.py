@@ -1,56 +1,733 @@
-import BeautifulSoup
+import calendar
+import collections
+import datetime
+import email.utils
+import entryindex
+import excerpt
 import functools
 import hashlib
+import httplib
 import json
+import math
+import mediarss
 import os
 import re
+import storage
+import struct
+import threading
+import time
+import tornado.escape
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+import tornado.locale
 import tornado.web
 import tornado.wsgi
 import unicodedata
 import urllib
-import uuid
+import urlparse
 import wsgiref.handlers
+import zlib
 
-from google.appengine.ext import db
-from google.appengine.api import memcache
-from google.appengine.api import urlfetch
-from google.appengine.api import users
+try:
+    from google.appengine.api import memcache
+    from google.appengine.api import taskqueue
+    from google.appengine.api import urlfetch
+    from google.appengine.api import users
+    # Imported into this module too so that entities pickled into memcache
+    # before the models moved still load
+    from models import Entry, EntrySummary, JSONProperty, Tag
+except ImportError:
+    # Running standalone (see server.py), without the App Engine SDK. The
+    # counters are shared between the workers prefork.py starts. Only
+    # imported here, the sandbox has no mmap or multiprocessing
+    import standalone
+    memcache = standalone.Memcache(counters=("generation", "last_change",
+        "slugs_version", "tag_generation:"))
+    taskqueue = urlfetch = users = None
+    Entry = EntrySummary = Tag = None
+
+STANDALONE = users is None
+
+# Part of the keys of everything cached rendered, since App Engine's memcache
+# outlives deploys and templates change with them. Standalone caches don't
+# outlive the process
+APP_VERSION = os.environ.get("CURRENT_VERSION_ID", "")
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 def administrator(method):
     @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
-        user = users.get_current_user()
+        user = self.current_user
         if not user:
             if self.request.method == "GET":
-                self.redirect(users.create_login_url(self.request.uri))
+                self.redirect(self.settings["auth"].create_login_url(
+                    self.request.uri))
                 return
             raise tornado.web.HTTPError(403)
-        elif not users.is_current_user_admin():
+        elif not user.administrator:
             raise tornado.web.HTTPError(403)
         else:
             return method(self, *args, **kwargs)
     return wrapper
 
 
-class Entry(db.Model):
-    author = db.UserProperty()
-    title = db.StringProperty(required=True)
-    slug = db.StringProperty(required=True)
-    body = db.TextProperty(required=True)
-    published = db.DateTimeProperty(auto_now_add=True)
-    updated = db.DateTimeProperty(auto_now=True)
-    tags = db.ListProperty(db.Category)
-    hidden = db.BooleanProperty(default=False)
-
-
-class BaseHandler(tornado.web.RequestHandler):
-    def get_current_user(self):
+class AppEngineAuth(object):
+    # Sign-in through the App Engine users service, standalone.PasswordAuth
+    # is the standalone server's counterpart
+    def get_current_user(self, handler):
         user = users.get_current_user()
         if user:
             user.administrator = users.is_current_user_admin()
         return user
 
+    def create_login_url(self, dest_url):
+        return users.create_login_url(dest_url)
+
+    def create_logout_url(self, dest_url):
+        return users.create_logout_url(dest_url)
+
+
+backend = storage.from_url(os.environ.get("BLOG_STORAGE"), Entry, Tag,
+                           EntrySummary)
+
+
+def get_counter(name):
+    # Counters are seeded from the clock so that a counter evicted by memcache
+    # never comes back with a previously used value
+    value = memcache.get(name)
+    if value is None:
+        value = int(time.time() * 1000)
+        if not memcache.add(name, value):
+            value = memcache.get(name) or value
+    return value
+
+
+def incr_counter(name):
+    memcache.incr(name, initial_value=int(time.time() * 1000))
+
+
+def get_content_version():
+    # The generation is part of the key of every rendered page that depends on
+    # more than one entry (e.g. through the recent entries sidebar) so a single
+    # increment invalidates all of them. Together with the time of the last
+    # change it also makes up the validators for conditional GETs
+    values = memcache.get_multi(["generation", "last_change"])
+    generation = values.get("generation")
+    if generation is None:
+        generation = get_counter("generation")
+    last_change = values.get("last_change")
+    if last_change is None:
+        last_change = get_counter("last_change")
+    # Last-Modified only has whole seconds, rounded up so that a client that
+    # saw the page before the change doesn't have the same one
+    return (generation,
+            datetime.datetime.utcfromtimestamp((last_change + 999) // 1000))
+
+
+def record_change():
+    # The time of the last change is a counter of milliseconds, seeded from
+    # the clock like the others: storage can't tell when something was last
+    # deleted, and a time that is lost comes back later rather than earlier,
+    # so Last-Modified never goes backwards
+    last_change = get_counter("last_change")
+    memcache.incr("last_change", max(1, int(time.time() * 1000) - last_change),
+                  initial_value=last_change)
+
+
+def invalidate_entry(entry, deleted=False, old_tags=(), old_key=None):
+    # Write the entry through rather than just deleting it so CatchAllHandler
+    # can find new entries before the slug filter on every instance has caught
+    # up
+    if deleted:
+        memcache.delete("entry:" + entry.slug)
+    else:
+        memcache.set("entry:" + entry.slug, entry)
+    entry_index.update(entry, deleted, old_key)
+    # Tag listings have a generation of their own so saving an entry only
+    # invalidates the tags it has, or had before an edit
+    tags = set(entry.tags) | set(old_tags)
+    if tags:
+        memcache.offset_multi(dict(("tag_generation:" + tag, 1)
+            for tag in tags), initial_value=int(time.time() * 1000))
+    # Deleting or hiding an entry changes pages without changing the updated
+    # time of anything left on them
+    record_change()
+
+
+def encoded_etag(etag, encoding):
+    # The ETag of a compressed variant, see CompressedBody
+    return etag[:-1] + "-" + encoding + '"'
+
+
+def is_fresh(if_none_match, if_modified_since, etag, last_modified):
+    # Whether a conditional request can be answered with a 304. Compressed
+    # responses carry the tag of their encoding
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        tags = [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+        valid = [etag] + [encoded_etag(etag, encoding)
+                          for (encoding, compress) in COMPRESSORS]
+        return "*" in tags or any(tag in valid for tag in tags)
+    if if_modified_since:
+        since = email.utils.parsedate_tz(if_modified_since)
+        return since is not None and email.utils.mktime_tz(since) >= \
+            calendar.timegm(last_modified.utctimetuple())
+    return False
+
+
+class LocalCache(object):
+    # A small per-instance LRU in front of memcache for values read on every
+    # request. Keys should carry the generation so nothing here goes stale
+    def __init__(self, size=1000):
+        self.size = size
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.pop(key, None)
+            if value is not None:
+                self.data[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+
+local_cache = LocalCache()
+# Rendered UI module output, see CachedModule
+fragment_cache = LocalCache(500)
+
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate=0.01):
+        self.num_bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(
+            float(self.num_bits) / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def positions(self, value):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        (h1, h2) = struct.unpack("<QQ", hashlib.md5(value).digest())
+        return [(h1 + i * h2) % self.num_bits for i in xrange(self.num_hashes)]
+
+    def add(self, value):
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        for position in self.positions(value):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class SlugFilter(object):
+    # Answers "definitely not an entry" for the stray paths that end up in
+    # CatchAllHandler without a datastore query. The filter is built the first
+    # time it is used on an instance and rebuilt whenever a miss sees that
+    # another request created or deleted an entry. Like the entry index, the
+    # slugs of each version are shared through memcache and writers store the
+    # next version's before moving the version on, so no instance builds it
+    # from a projection query that may not see the write yet
+    def __init__(self, storage):
+        self.storage = storage
+        self.bloom = None
+        self.version = None
+        self.lock = threading.Lock()
+
+    def load(self, version):
+        cache_key = "slugs:%s" % version
+        slugs = memcache.get(cache_key)
+        if slugs is None:
+            slugs = self.storage.slugs()
+            memcache.add(cache_key, slugs)
+        return slugs
+
+    def build(self, slugs, version):
+        bloom = BloomFilter(max(1024, 2 * len(slugs)))
+        for slug in slugs:
+            bloom.add(slug)
+        (self.bloom, self.version) = (bloom, version)
+
+    def rebuild(self, version):
+        self.build(self.load(version), version)
+
+    def update(self, added=None, removed=None):
+        with self.lock:
+            current = get_counter("slugs_version")
+            slugs = set(self.load(current))
+            slugs.discard(removed)
+            if added:
+                slugs.add(added)
+            slugs = sorted(slugs)
+            memcache.set("slugs:%s" % (current + 1), slugs)
+            version = memcache.incr("slugs_version",
+                                    initial_value=int(time.time() * 1000))
+            if version != current + 1:
+                # Another write got in between
+                memcache.set("slugs:%s" % version, slugs)
+            self.build(slugs, version)
+
+    def __contains__(self, slug):
+        if self.bloom is None:
+            self.rebuild(get_counter("slugs_version"))
+        if slug in self.bloom:
+            return True
+        version = get_counter("slugs_version")
+        if version == self.version:
+            return False
+        self.rebuild(version)
+        return slug in self.bloom
+
+
+slug_filter = SlugFilter(backend)
+
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+# Content codings in order of preference, brotli only when it is installed
+COMPRESSORS = [("gzip", gzip_compress)]
+if brotli is not None:
+    COMPRESSORS.insert(0, ("br", brotli.compress))
+
+
+class CompressedBody(object):
+    # A response body along with its compressed encodings, which are made once
+    # when the body is cached rather than on every request that gets it.
+    # Encodings that don't make the body smaller are left out
+    def __init__(self, body, content_type):
+        self.body = tornado.escape.utf8(body)
+        self.content_type = content_type
+        self.encodings = {}
+        for (encoding, compress) in COMPRESSORS:
+            data = compress(self.body)
+            if len(data) < len(self.body):
+                self.encodings[encoding] = data
+
+    def negotiate(self, accept_encoding):
+        # Returns (encoding, data), encoding being None for the plain body
+        accepted = set()
+        for coding in (accept_encoding or "").split(","):
+            params = [param.strip() for param in coding.split(";")]
+            if any(param.replace(" ", "") in ("q=0", "q=0.0", "q=0.00",
+                                             "q=0.000")
+                   for param in params[1:]):
+                continue
+            accepted.add(params[0].lower())
+        for (encoding, compress) in COMPRESSORS:
+            if encoding in self.encodings and encoding in accepted:
+                return (encoding, self.encodings[encoding])
+        return (None, self.body)
+
+
+# Where layout.html leaves room for the parts of a page that aren't shared,
+# in the order they come in the layout. The marker itself never reaches a
+# response
+LAYOUT_HOLE = "<!--hole:%s-->" % os.urandom(8).encode("hex")
+LAYOUT_HOLES = ("title", "head", "content", "account", "bottom")
+
+
+class StaticManifest(object):
+    # The content hash and contents of every file under the static directory,
+    # read once when the instance starts. Static files only change with a
+    # deploy, which starts new instances
+    def __init__(self, path):
+        self.files = {}
+        for (root, dirs, names) in os.walk(path):
+            for name in names:
+                abspath = os.path.abspath(os.path.join(root, name))
+                with open(abspath, "rb") as f:
+                    data = f.read()
+                self.files[abspath] = (hashlib.md5(data).hexdigest(), data)
+
+    def get(self, abspath):
+        # (hash, contents), or None for files that weren't there at startup
+        return self.files.get(os.path.abspath(abspath))
+
+
+static_manifest = StaticManifest(os.path.join(os.path.dirname(__file__),
+                                              "static"))
+
+
+class EntryIndexLoader(object):
+    # Keeps this instance's EntryIndex at the current generation. Indexes are
+    # shared through memcache, so only the first instance to see a generation
+    # loads it from storage. Writers derive the next index from the previous
+    # one rather than from a query that may not see their write yet, and
+    # store it before moving the generation on so no instance can see the
+    # generation first
+    def __init__(self, storage):
+        self.storage = storage
+        self.index = entryindex.EntryIndex([])
+        self.lock = threading.Lock()
+
+    def load(self, generation):
+        cache_key = "entry_index:%s" % generation
+        rows = memcache.get(cache_key)
+        if rows is None:
+            rows = self.storage.metadata()
+            memcache.add(cache_key, rows)
+        return entryindex.EntryIndex(rows, generation)
+
+    def get(self, generation):
+        index = self.index
+        if index.version != generation:
+            with self.lock:
+                if self.index.version != generation:
+                    self.index = self.load(generation)
+                index = self.index
+        return index
+
+    def update(self, entry, deleted, old_key):
+        # Moves the generation on, returning the new one
+        with self.lock:
+            current = get_counter("generation")
+            index = self.index
+            if index.version != current:
+                index = self.load(current)
+            keys = set([str(entry.key()), old_key])
+            index = index.replace(keys,
+                None if deleted else storage.metadata(entry), current + 1)
+            memcache.set("entry_index:%s" % index.version, index.rows())
+            generation = memcache.incr("generation",
+                                       initial_value=int(time.time() * 1000))
+            if generation != index.version:
+                # Another write got in between, this index goes with the
+                # generation we got
+                index = entryindex.EntryIndex(index.rows(), generation)
+                memcache.set("entry_index:%s" % generation, index.rows())
+            self.index = index
+        return generation
+
+
+entry_index = EntryIndexLoader(backend)
+
+
+def sup_id(url):
+    return hashlib.md5(url).hexdigest()[:10]
+
+
+def ping_args(settings, host, endpoint):
+    # The urlencoded arguments of a ping, see the ping_endpoints setting
+    feed = "http://" + host + "/?format=atom"
+    values = {
+        "feed": feed,
+        "home": "http://" + host + "/",
+        "sup_id": sup_id(feed),
+        "title": settings["blog_title"],
+    }
+    return urllib.urlencode([(name, tornado.escape.utf8(value % values))
+        for (name, value) in sorted(endpoint["args"].items())])
+
+
+# Hosts with pings waiting to be sent by the standalone server
+pending_pings = set()
+
+
+def schedule_pings(settings, host):
+    # The standalone server's task queue: pings for a host wait ping_delay
+    # seconds, and publishing again in the meantime doesn't add more
+    if host in pending_pings:
+        return
+    pending_pings.add(host)
+
+    def send():
+        pending_pings.discard(host)
+        return send_pings(settings, host)
+    tornado.ioloop.IOLoop.current().call_later(
+        settings.get("ping_delay", 30), send)
+
+
+@tornado.gen.coroutine
+def send_pings(settings, host):
+    # PingHandler for the standalone server: every endpoint at once through
+    # AsyncHTTPClient, failed ones again with the same backoff
+    client = tornado.httpclient.AsyncHTTPClient()
+    endpoints = settings["ping_endpoints"]
+    for attempt in xrange(settings.get("ping_retries", 3) + 1):
+        if attempt:
+            yield tornado.gen.sleep(2 ** (attempt - 1) * 10)
+        fetches = []
+        for endpoint in endpoints:
+            args = ping_args(settings, host, endpoint)
+            timeout = endpoint.get("deadline",
+                                   settings.get("ping_deadline", 10))
+            if endpoint.get("method", "GET") == "POST":
+                fetches.append(client.fetch(endpoint["url"], method="POST",
+                    body=args, request_timeout=timeout, raise_error=False))
+            else:
+                fetches.append(client.fetch(endpoint["url"] + "?" + args,
+                    request_timeout=timeout, raise_error=False))
+        responses = yield fetches
+        endpoints = [endpoint for (endpoint, response)
+                     in zip(endpoints, responses)
+                     if not 200 <= response.code < 300]
+        if not endpoints:
+            break
+
+
+class BaseHandler(tornado.web.RequestHandler):
+    # The query arguments that make a different page of the same path
+    PAGE_ARGUMENTS = ("format", "full", "pretty")
+
+    def get_current_user(self):
+        return self.settings["auth"].get_current_user(self)
+
+    def run_blocking(self, function, *args, **kwargs):
+        # Storage, and memcache on App Engine, block. The standalone server
+        # runs them on its executor so the IOLoop keeps serving other
+        # requests; under WSGI there is nothing else to serve, so they are
+        # just called
+        executor = self.settings.get("executor")
+        if executor is None:
+            return tornado.gen.maybe_future(function(*args, **kwargs))
+        return executor.submit(function, *args, **kwargs)
+
+    @tornado.gen.coroutine
+    def prepare(self):
+        # Loads what every page's layout needs before anything renders, so
+        # templates only ever find it in memory. Not for writes, which must
+        # see the content version as it is after they are done
+        if self.request.method in ("GET", "HEAD"):
+            yield self.run_blocking(self.load_layout_data)
+
+    def load_layout_data(self):
+        self.get_content_version()
+        self.get_entry_index()
+        self.get_tag_counts()
+
+    @property
+    def storage(self):
+        return self.application.settings["storage"]
+
+    def get_viewer_class(self):
+        if not self.current_user:
+            return "anonymous"
+        return "admin" if self.current_user.administrator else "user"
+
+    def get_content_version(self):
+        if not hasattr(self, "_content_version"):
+            self._content_version = get_content_version()
+        return self._content_version
+
+    def check_not_modified(self):
+        # Called before anything is fetched or rendered, the validators only
+        # depend on the cached content version
+        (generation, last_modified) = self.get_content_version()
+        etag = '"%s"' % hashlib.md5("%s:%s:%s:%s:%s" % (generation,
+            self.request.host, self.get_viewer_class(), self.locale.code,
+            self.request.uri)).hexdigest()
+        self.set_header("Etag", etag)
+        self.set_header("Last-Modified", last_modified)
+        self.set_header("Vary", "Cookie, Accept-Encoding")
+        self._validators = (etag, last_modified)
+        fresh = is_fresh(self.request.headers.get("If-None-Match"),
+                         self.request.headers.get("If-Modified-Since"),
+                         etag, last_modified)
+        if fresh:
+            self.set_status(304)
+            self.finish()
+        return fresh
+
+    def get_entry_by_slug(self, slug):
+        cache_key = "entry:" + slug
+        entry = memcache.get(cache_key)
+        if entry is None:
+            entry = self.storage.get_by_slug(slug)
+            if entry:
+                memcache.add(cache_key, entry)
+        return entry
+
+    def render_cached(self, cache_key, template_name, **kwargs):
+        # Pages, feeds and JSON alike are rendered and compressed once per
+        # cache key. The arguments that change the output are part of the key,
+        # as the values they are understood as, so made up ones don't add keys.
+        # So is the return URI of the account box's links
+        cache_key = "page:%s:%s:%s:%s:%s:%s:%s:%s:%s" % (APP_VERSION,
+            self.request.host, self.get_viewer_class(), self.locale.code,
+            self.get_output_format(kwargs),
+            bool(self.get_argument("full", False)),
+            bool(self.get_argument("pretty", False)), self.get_return_uri(),
+            cache_key)
+        page = memcache.get(cache_key)
+        if page is None:
+            (content_type, body) = self.render_page(template_name, **kwargs)
+            page = CompressedBody(body, content_type)
+            memcache.set(cache_key, page)
+        if page.content_type == "application/atom+xml":
+            self.set_sup_header()
+        self.finish_compressed(page)
+
+    def finish_compressed(self, page):
+        # Sends the best encoding of a CompressedBody the client accepts.
+        # Responses to signed-out viewers are kept for AnonymousFastPath too
+        (encoding, data) = page.negotiate(
+            self.request.headers.get("Accept-Encoding"))
+        self.set_header("Content-Type", page.content_type)
+        vary = self._headers.get("Vary")
+        if not vary:
+            self.set_header("Vary", "Accept-Encoding")
+        elif "Accept-Encoding" not in vary:
+            self.set_header("Vary", vary + ", Accept-Encoding")
+        if not self.current_user and not STANDALONE:
+            self.cache_anonymous_response(page)
+        if encoding:
+            self.set_header("Content-Encoding", encoding)
+            etag = self._headers.get("Etag")
+            if etag:
+                self.set_header("Etag", encoded_etag(etag, encoding))
+        self.finish(data)
+
+    def cache_anonymous_response(self, page):
+        # Only pages that are there, at the URIs we link to: misses and URIs
+        # with arguments of their own (e.g. utm_source) would each take a
+        # cache entry for a response that is already cheap
+        if self.get_status() != 200 or not self.is_canonical_uri():
+            return
+        cache_key = anonymous_cache_key(self.request.host, self.request.uri,
+                                        self.get_content_version()[0])
+        if not cache_key:
+            return
+        (etag, last_modified) = getattr(self, "_validators", (None, None))
+        headers = [(name, value) for (name, value) in self._headers.get_all()
+                   if name not in ("Date", "Etag", "Server")]
+        memcache.set(cache_key, AnonymousResponse(self.get_status(), headers,
+                                                  page, etag, last_modified))
+
+    def is_canonical_uri(self):
+        # Whether the query only has PAGE_ARGUMENTS, each once and as we link
+        # to it
+        for (name, values) in self.request.query_arguments.iteritems():
+            if name not in self.PAGE_ARGUMENTS or len(values) != 1:
+                return False
+            if name == "cursor":
+                if values[0] != self.get_cursor():
+                    return False
+            elif name == "format":
+                if values[0] not in ("atom", "json"):
+                    return False
+            elif values[0] != "1":
+                return False
+        return True
+
+    def get_return_uri(self):
+        # Signing in from a missing page shouldn't land back on it, this also
+        # lets every 404 share one rendered body. Other pages are returned to
+        # with only the arguments they are rendered for, so the URI is the
+        # same for every request that gets the same cached page
+        if self.get_status() == 404:
+            return "/"
+        arguments = []
+        cursor = "cursor" in self.PAGE_ARGUMENTS and self.get_cursor()
+        if cursor:
+            arguments.append(("cursor", cursor))
+        for name in ("full", "pretty"):
+            if self.get_argument(name, False):
+                arguments.append((name, "1"))
+        if not arguments:
+            return self.request.path
+        return self.request.path + "?" + urllib.urlencode(arguments)
+
+    def render_not_found(self):
+        self.set_status(404)
+        self.render_cached("not_found:%s" % self.get_content_version()[0],
+            "404.html")
+
+    def get_entry_index(self):
+        return entry_index.get(self.get_content_version()[0])
+
+    def list_visible(self, limit, cursor=None):
+        # Listings come from the entry index, storage is only asked for the
+        # bodies of the page
+        (records, next_cursor) = self.get_entry_index().list_visible(limit,
+                                                                     cursor)
+        return (self.storage.get_multi([record.key for record in records]),
+                next_cursor)
+
+    def list_by_tag(self, tag, limit, cursor=None):
+        (records, next_cursor) = self.get_entry_index().list_by_tag(tag, limit,
+                                                                    cursor)
+        return (self.storage.get_multi([record.key for record in records]),
+                next_cursor)
+
+    def get_cached_entries(self, name, list_entries, limit, cursor=None,
+                           generation=None):
+        # The generation is in the cache key so every page, not just the first
+        # one, is replaced as soon as anything changes. Cursors we didn't hand
+        # out get the first page rather than a cache key of their own
+        if generation is None:
+            generation = self.get_content_version()[0]
+        cache_key = "%s:%s:%s:%s" % (name, generation, cursor, limit)
+        cached_data = memcache.get(cache_key)
+        if cached_data:
+            return cached_data
+        try:
+            data = list_entries(limit, cursor)
+        except storage.BadCursorError:
+            return self.get_cached_entries(name, list_entries, limit,
+                                           generation=generation)
+        memcache.add(cache_key, data)
+        return data
+
+    def get_home_entries(self, cursor):
+        return self.get_cached_entries("home_entries", self.list_visible,
+            self.application.settings.get("num_home", 5), cursor)
+
+    def get_cursor(self):
+        # The cursor argument as the one we hand out for the same page, so
+        # only cursors of real pages ever make it into cache keys. Cursors we
+        # didn't hand out get the first page
+        try:
+            return self.get_entry_index().normalize(
+                self.get_argument("cursor", None))
+        except storage.BadCursorError:
+            return None
+
+    def get_summaries(self, list_records, limit, cursor):
+        # Summary listings are answered by the entry index alone
+        try:
+            return list_records(limit, cursor)
+        except storage.BadCursorError:
+            return list_records(limit)
+
+    def get_local_cached(self, cache_key, compute):
+        # For values shown on every page: kept in memory as well as memcache
+        value = local_cache.get(cache_key)
+        if value is None:
+            value = memcache.get(cache_key)
+            if value is None:
+                value = compute()
+                memcache.add(cache_key, value)
+            local_cache.set(cache_key, value)
+        return value
+
+    def get_recent_entries(self):
+        return self.get_entry_index().list_visible(
+            self.application.settings.get("num_home", 5))[0]
+
+    def get_tag_counts(self):
+        return self.get_local_cached("tag_counts:%s:%s" % (
+            self.get_content_version()[0],
+            self.application.settings.get("num_tags", 30)),
+            lambda: self.storage.tag_counts(
+                self.application.settings.get("num_tags", 30)))
+
     def get_integer_argument(self, name, default):
         try:
             return int(self.get_argument(name, default))
@@ -59,39 +736,103 @@ class BaseHandler(tornado.web.RequestHandler):
 
     def render_string(self, template_name, **kwargs):
         return tornado.web.RequestHandler.render_string(self, template_name,
-            users=users, **kwargs)
+            auth=self.settings["auth"], **kwargs)
 
-    def render(self, template_name, **kwargs):
+    def get_output_format(self, kwargs):
         format = self.get_argument("format", None)
-        if "entries" in kwargs and isinstance(kwargs["entries"], db.Query):
-            # Force evaluate queries so we know if there are entries before
-            # trying to render a feed
-            kwargs["entries"] = list(kwargs["entries"])
         if kwargs.get("entries") and format == "atom":
-            self.set_header("Content-Type", "application/atom+xml")
-            self.set_sup_header()
-            template_name = "atom.xml"
+            return "atom"
         if "entries" in kwargs and format == "json":
+            return "json"
+        return None
+
+    def render(self, template_name, **kwargs):
+        format = self.get_output_format(kwargs)
+        if not format:
+            self.finish(self.render_layout(template_name, **kwargs))
+            return
+        (content_type, body) = self.render_page(template_name, **kwargs)
+        self.set_header("Content-Type", content_type)
+        if format == "atom":
+            self.set_sup_header()
+        self.finish(body)
+
+    def render_page(self, template_name, **kwargs):
+        # Returns the content type and body render would send
+        format = self.get_output_format(kwargs)
+        if format == "atom":
+            kwargs["feed_id"] = self.request.full_url()
+            kwargs["link"] = "http://" + self.request.host + self.request.path
+            return ("application/atom+xml",
+                    self.render_string("atom.xml", **kwargs))
+        if format == "json":
+            # Bodies can be large, so only excerpts are sent unless full=1
+            full = bool(self.get_argument("full", False))
             json_entries = [{
                 "title": entry.title,
                 "slug": entry.slug,
-                "body": entry.body,
+                "excerpt": entry.excerpt if entry.excerpt is not None else
+                    entry.body,
+                "word_count": entry.word_count,
+                "reading_time": entry.reading_time,
                 "author": entry.author.nickname(),
                 "published": entry.published.isoformat(),
                 "updated": entry.updated.isoformat(),
                 "tags": entry.tags,
                 "link": "http://" + self.request.host + "/" + entry.slug,
             } for entry in kwargs["entries"]]
+            if full:
+                for (data, entry) in zip(json_entries, kwargs["entries"]):
+                    data["body"] = entry.body
             data = {
                 "entries": json_entries,
             }
             if "cursor" in kwargs:
                 data["cursor"] = kwargs["cursor"]
-            self.set_header("Content-Type", "text/javascript")
-            self.write(json.dumps(data, sort_keys=True, indent=4) if 
-                self.get_argument("pretty", False) else data)
-            return
-        return tornado.web.RequestHandler.render(self, template_name, **kwargs)
+            if self.get_argument("pretty", False):
+                return ("text/javascript",
+                        json.dumps(data, sort_keys=True, indent=4))
+            return ("application/json; charset=UTF-8",
+                    tornado.escape.json_encode(data))
+        return ("text/html; charset=UTF-8",
+                self.render_layout(template_name, **kwargs))
+
+    def get_layout(self):
+        # layout.html split at its holes. Nothing in it depends on the viewer
+        # or the page, so it is rendered once per sidebar generation, locale
+        # and (for the copyright line) year
+        return self.get_local_cached("layout:%s:%s:%s:%s" % (
+            APP_VERSION, self.get_content_version()[0], self.locale.code,
+            datetime.datetime.utcnow().year),
+            lambda: self.render_string("layout.html",
+                                       hole=LAYOUT_HOLE).split(LAYOUT_HOLE))
+
+    def render_layout(self, template_name, **kwargs):
+        # Pages extend base.html, which only renders their blocks, separated
+        # by LAYOUT_HOLE. The blocks and the viewer's account box go into the
+        # holes of the cached layout
+        blocks = self.render_string(template_name, hole=LAYOUT_HOLE,
+                                    **kwargs).split(LAYOUT_HOLE)
+        fills = dict(zip(("title", "head", "content", "bottom"), blocks))
+        fills["account"] = self.render_string("account.html")
+        layout = self.get_layout()
+        parts = [layout[0]]
+        for (name, segment) in zip(LAYOUT_HOLES, layout[1:]):
+            parts.append(fills[name])
+            parts.append(segment)
+        return "".join(parts)
+
+    def get_body_fields(self, body):
+        # The fields derived from the body, saved with it so that requests
+        # never have to parse it
+        (entry_excerpt, word_count) = excerpt.extract_excerpt(body,
+            self.application.settings.get("excerpt_words", 150))
+        return {
+            "excerpt": entry_excerpt,
+            "reading_time": excerpt.reading_time(word_count),
+            "thumbnails": mediarss.extract_thumbnails(body),
+            "word_count": word_count,
+        }
 
     def slugify(self, value):
         slug = unicodedata.normalize("NFKD", value).encode(
@@ -100,60 +841,57 @@ class BaseHandler(tornado.web.RequestHandler):
         return "-".join(slug.lower().strip().split())
 
     def generate_sup_id(self, url=None):
-        return hashlib.md5(url or self.request.full_url()).hexdigest()[:10]
+        return sup_id(url or self.request.full_url())
 
     def set_sup_header(self, url=None):
         sup_id = self.generate_sup_id(url)
         self.set_header("X-SUP-ID",
             "http://friendfeed.com/api/public-sup.json#" + sup_id) 
 
+    def render_feed(self, entries, link):
+        return CompressedBody(self.render_string("atom.xml", entries=entries,
+            feed_id=link + "?format=atom", link=link), "application/atom+xml")
+
+    def finish_feed(self, feed, link):
+        self.set_sup_header(link + "?format=atom")
+        self.finish_compressed(feed)
+
+    def get_feed_key(self):
+        return "feed:%s:%s:%s" % (APP_VERSION, self.request.host,
+                                  self.get_content_version()[0])
+
+    def build_feed(self):
+        # The home feed is by far the most polled URL so it is rendered once
+        # per generation and host rather than on every poll. Writers render
+        # it for their own host right away. Empty if there are no entries
+        (entries, cursor) = self.list_visible(
+            self.application.settings.get("num_home", 5))
+        feed = self.render_feed(entries, "http://" + self.request.host + "/") \
+            if entries else ""
+        memcache.add(self.get_feed_key(), feed)
+        return feed
+
     def ping(self):
-        # Swallow exceptions when pinging, urlfetch can be unstable and it
-        # isn't the end of the world if a ping doesn't make it. Since we don't
-        # care about the response, in an ideal world, the urlfetch API would
-        # have an option to perform all of this asynchronously and optionally
-        # specify a number of retries
-        feed = "http://" + self.request.host + "/?format=atom"
-        args = urllib.urlencode({
-            "name": self.application.settings["blog_title"],
-            "url": "http://" + self.request.host + "/",
-            "changesURL": feed,
-        })
-        try:
-            urlfetch.fetch("http://blogsearch.google.com/ping?" + args)
-        except:
-            pass
-        args = urllib.urlencode({
-            "url": feed,
-            "supid": self.generate_sup_id(feed),
-        })
-        try:
-            urlfetch.fetch("http://friendfeed.com/api/public-sup-ping?" + args)
-        except:
-            pass
-        args = urllib.urlencode({
-            "bloglink": "http://" + self.request.host + "/",
-        })
-        try:
-            urlfetch.fetch("http://www.feedburner.com/fb/a/pingSubmit?" + args)
-        except:
-            pass
-        args = urllib.urlencode({
-            "hub.mode": "publish",
-            "hub.url": feed,
-        })
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded",
-        }
+        # Pings go through the task queue so publishing doesn't wait on third
+        # party endpoints. Every publish within the same ping_delay window maps
+        # to the same task name, so a burst of edits sends a single set of
+        # pings once the window has passed
+        delay = self.application.settings.get("ping_delay", 30)
+        if taskqueue is None:
+            schedule_pings(self.application.settings, self.request.host)
+            return
+        name = "ping-%s-%d" % (hashlib.md5(self.request.host).hexdigest()[:10],
+                               int(time.time() // delay))
         try:
-            result = urlfetch.fetch("http://pubsubhubbub.appspot.com/",
-                payload=args, method=urlfetch.POST, headers=headers)
-        except:
+            taskqueue.add(url="/tasks/ping", name=name, countdown=delay,
+                          params={"host": self.request.host})
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
             pass
 
     def get_error_html(self, status_code, **kwargs):
         if status_code == 404:
-            self.write(self.render_string("404.html"))
+            self.write(self.render_layout("404.html"))
         else:
             return tornado.web.RequestHandler.get_error_html(self, status_code,
                                                              **kwargs)
@@ -163,31 +901,64 @@ class BaseHandler(tornado.web.RequestHandler):
             self.set_sup_header()
 
 
+class StaticHandler(tornado.web.StaticFileHandler):
+    # Versions and serves static files from the manifest. The version in the
+    # ?v= of static_url changes with the contents, so versioned URLs can be
+    # cached for good
+    IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+    @classmethod
+    def get_version(cls, settings, path):
+        found = static_manifest.get(cls.get_absolute_path(
+            settings["static_path"], path))
+        return found[0] if found else None
+
+    @classmethod
+    def get_content(cls, abspath, start=None, end=None):
+        found = static_manifest.get(abspath)
+        if found is None:
+            return tornado.web.StaticFileHandler.get_content(abspath, start,
+                                                             end)
+        return found[1][start:end]
+
+    @classmethod
+    def get_content_version(cls, abspath):
+        found = static_manifest.get(abspath)
+        if found is None:
+            return tornado.web.StaticFileHandler.get_content_version(abspath)
+        return found[0]
+
+    def get_cache_time(self, path, modified, mime_type):
+        if "v" in self.request.arguments:
+            return self.IMMUTABLE_MAX_AGE
+        return 0
+
+    def set_extra_headers(self, path):
+        if "v" in self.request.arguments:
+            self.set_header("Cache-Control",
+                "public, max-age=%d, immutable" % self.IMMUTABLE_MAX_AGE)
+
+
 class HomeHandler(BaseHandler):
+    PAGE_ARGUMENTS = BaseHandler.PAGE_ARGUMENTS + ("cursor",)
+
+    @tornado.gen.coroutine
     def get(self):
-        cursor = self.get_argument("cursor", None)
-        limit = self.application.settings.get("num_home", 5)
-        # The cursor is in the cache key. We never evict caches other than
-        # 'home_entries:None:5' which is the front page. Doing so will cause
-        # the cursors to change and thus change the key. Eventually memcache
-        # will evict the cache keys containing cursors that are never fetched
-        # once memory usage goes high because stale cursors should never get hit
-        # and hopefully the App Engine memcache service prunes cold keys first
-        cache_key = 'home_entries:%s:%s' % (cursor, limit)
-        cached_data = memcache.get(cache_key)
-        if cached_data:
-            (entries, new_cursor) = cached_data
-        else:
-            q = db.Query(Entry).filter("hidden =", False).order("-published")
-            if cursor:
-                try:
-                    q.with_cursor(cursor)
-                except (db.BadRequestError, db.BadValueError):
-                    cursor = None
-            entries = q.fetch(limit=limit)
-            new_cursor = q.cursor() if len(entries) == limit else None
-            memcache.add(cache_key, (entries, new_cursor))
-        self.render("home.html", entries=entries, cursor=new_cursor)
+        if self.check_not_modified():
+            return
+        cursor = self.get_cursor()
+        if self.get_argument("format", None) == "atom" and not cursor:
+            feed = memcache.get(self.get_feed_key())
+            if feed is None:
+                feed = yield self.run_blocking(self.build_feed)
+            if feed:
+                self.finish_feed(feed, "http://" + self.request.host + "/")
+                return
+        (entries, new_cursor) = yield self.run_blocking(
+            self.get_home_entries, cursor)
+        self.render_cached("home:%s:%s" % (self.get_content_version()[0],
+            cursor), "home.html", entries=entries, cursor=new_cursor,
+            full=bool(self.get_argument("full", False)))
 
 
 class AboutHandler(BaseHandler):
@@ -197,65 +968,67 @@ class AboutHandler(BaseHandler):
 
 
 class ArchiveHandler(BaseHandler):
+    PAGE_ARGUMENTS = BaseHandler.PAGE_ARGUMENTS + ("cursor",)
+
     @tornado.web.removeslash
+    @tornado.gen.coroutine
     def get(self):
-        q = db.Query(Entry).filter("hidden =", False).order("-published")
-        cursor = self.get_argument("cursor", None)
-        if cursor:
-            try:
-                q.with_cursor(cursor)
-            except (db.BadRequestError, db.BadValueError):
-                cursor = None
+        if self.check_not_modified():
+            return
+        # The archive page itself only needs summaries, its feeds need the
+        # whole entries
         limit = self.application.settings.get("num_archive", 10)
-        entries = q.fetch(limit=limit)
-        cursor = q.cursor() if len(entries) == limit else None
-        self.render("archive.html", entries=entries, cursor=cursor)
+        cursor = self.get_cursor()
+        if self.get_argument("format", None):
+            (entries, next_cursor) = yield self.run_blocking(
+                self.get_cached_entries, "archive_entries", self.list_visible,
+                limit, cursor)
+        else:
+            (entries, next_cursor) = self.get_summaries(
+                self.get_entry_index().list_visible, limit, cursor)
+        self.render_cached("archive:%s:%s" % (self.get_content_version()[0],
+            cursor), "archive.html", entries=entries, cursor=next_cursor)
 
 
 class ComposeHandler(BaseHandler):
     @administrator
     def get(self):
         key = self.get_argument("key", None)
-        try:
-            entry = Entry.get(key) if key else None
-        except db.BadKeyError:
-            entry = None
+        entry = self.storage.get(key) if key else None
         self.render("compose.html", entry=entry)
 
     @administrator
     def post(self):
         key = self.get_argument("key", None)
+        old_tags = []
         if key:
-            try:
-                entry = Entry.get(key)
-            except db.BadKeyError:
+            entry = self.storage.get(key)
+            if not entry:
                 self.redirect("/")
                 return
-            entry.body = self.get_argument("body")
-            entry.title = self.get_argument("title")
+            old_tags = list(entry.tags)
+        tags = set([self.slugify(unicode(tag)) for tag in
+            self.get_argument("tags", "").split(",")])
+        fields = {
+            "body": self.get_argument("body"),
+            "hidden": bool(self.get_argument("hidden", False)),
+            "tags": [tag for tag in tags if tag],
+            "title": self.get_argument("title"),
+        }
+        fields.update(self.get_body_fields(fields["body"]))
+        if key:
+            self.storage.update(entry, **fields)
+            self.storage.put(entry)
         else:
-            title = self.get_argument("title")
-            slug = self.slugify(title)
+            slug = self.slugify(fields["title"])
             if not slug:
                 slug = "entry"
-            original_slug = slug
-            while db.Query(Entry).filter("slug = ", slug).get():
-                slug = original_slug + "-" + uuid.uuid4().hex[:2]
-            entry = Entry(
-                author=self.current_user,
-                body=self.get_argument("body"),
-                slug=slug,
-                title=title,
-            )
-        tags = set([self.slugify(unicode(tag)) for tag in
-            self.get_argument("tags", "").split(",")])
-        tags = [db.Category(tag) for tag in tags if tag]
-        entry.tags = tags
-        entry.hidden = bool(self.get_argument("hidden", False))
-        entry.put()
-        memcache.delete('home_entries:%s:%s' %
-          (None, self.application.settings.get("num_home", 5))
-        )
+            entry = self.storage.create(slug, author=self.current_user,
+                                        **fields)
+        invalidate_entry(entry, old_tags=old_tags)
+        if not key:
+            slug_filter.update(added=entry.slug)
+        self.build_feed()
         if not key and not entry.hidden:
             self.ping()
         self.redirect("/" + entry.slug)
@@ -264,46 +1037,204 @@ class ComposeHandler(BaseHandler):
 class DeleteHandler(BaseHandler):
     @administrator
     def get(self):
-        key = self.get_argument("key")
-        try:
-            entry = Entry.get(key)
-        except db.BadKeyError:
+        entry = self.storage.get(self.get_argument("key"))
+        if not entry:
             raise tornado.web.HTTPError(404)
         self.render("delete.html", entry=entry)
 
     @administrator
     def post(self):
-        key = self.get_argument("key")
-        try:
-            entry = Entry.get(key)
-        except db.BadKeyError:
+        entry = self.storage.get(self.get_argument("key"))
+        if not entry:
             raise tornado.web.HTTPError(404)
-        entry.delete()
+        self.storage.delete(entry)
+        invalidate_entry(entry, deleted=True)
+        slug_filter.update(removed=entry.slug)
+        self.build_feed()
         self.redirect("/")
 
 
 class HideHandler(BaseHandler):
     @administrator
     def get(self):
-        key = self.get_argument("key")
-        try:
-            entry = Entry.get(key)
-        except db.BadKeyError:
+        entry = self.storage.get(self.get_argument("key"))
+        if not entry:
             raise tornado.web.HTTPError(404)
         self.render("hide.html", entry=entry)
 
     @administrator
     def post(self):
-        key = self.get_argument("key")
-        try:
-            entry = Entry.get(key)
-        except db.BadKeyError:
+        entry = self.storage.get(self.get_argument("key"))
+        if not entry:
             raise tornado.web.HTTPError(404)
-        entry.hidden = not bool(self.get_argument("unhide", False))
-        entry.put()
+        self.storage.update(entry,
+            hidden=not bool(self.get_argument("unhide", False)))
+        self.storage.put(entry)
+        invalidate_entry(entry)
+        self.build_feed()
         self.redirect("/")
 
 
+class PingHandler(BaseHandler):
+    # Runs the pings queued by BaseHandler.ping concurrently. Endpoints that
+    # fail are queued again on their own with exponential backoff until
+    # ping_retries is reached, after which we give up; a missed ping isn't the
+    # end of the world
+    def check_xsrf_cookie(self):
+        # Task queue requests don't carry an XSRF cookie, they are recognized
+        # by the header below which App Engine strips from external requests
+        pass
+
+    def post(self):
+        if not self.request.headers.get("X-AppEngine-QueueName"):
+            raise tornado.web.HTTPError(403)
+        settings = self.application.settings
+        host = self.get_argument("host")
+        urls = self.get_arguments("endpoint")
+        endpoints = [endpoint for endpoint in settings["ping_endpoints"]
+                     if not urls or endpoint["url"] in urls]
+        rpcs = []
+        for endpoint in endpoints:
+            args = ping_args(settings, host, endpoint)
+            rpc = urlfetch.create_rpc(deadline=endpoint.get("deadline",
+                settings.get("ping_deadline", 10)))
+            if endpoint.get("method", "GET") == "POST":
+                urlfetch.make_fetch_call(rpc, endpoint["url"], payload=args,
+                    method=urlfetch.POST, headers={
+                        "Content-Type": "application/x-www-form-urlencoded",
+                    })
+            else:
+                urlfetch.make_fetch_call(rpc, endpoint["url"] + "?" + args)
+            rpcs.append((endpoint, rpc))
+        failed = []
+        for (endpoint, rpc) in rpcs:
+            try:
+                if not 200 <= rpc.get_result().status_code < 300:
+                    failed.append(endpoint["url"])
+            except Exception:
+                failed.append(endpoint["url"])
+        attempt = self.get_integer_argument("attempt", 0)
+        if failed and attempt < settings.get("ping_retries", 3):
+            taskqueue.add(url="/tasks/ping", countdown=2 ** attempt * 10,
+                          params={
+                              "host": host,
+                              "endpoint": failed,
+                              "attempt": attempt + 1,
+                          })
+
+
+class BackfillThumbnailsHandler(BaseHandler):
+    # One-off job filling in Entry.thumbnails, the excerpt and the word count
+    # for entries written before they were extracted at save time. Each
+    # request handles one batch and redirects to the next until there is
+    # nothing left
+    @administrator
+    def get(self):
+        try:
+            (entries, cursor) = self.storage.list_all(50,
+                self.get_argument("cursor", None))
+        except storage.BadCursorError:
+            raise tornado.web.HTTPError(400)
+        for entry in entries:
+            self.storage.update(entry, **self.get_body_fields(entry.body))
+        # Backfilling isn't an edit, so don't touch Entry.updated and make every
+        # entry look new to feed readers. Cached copies and pages have to go
+        # all the same
+        self.storage.put_multi(entries, touch=False)
+        for entry in entries:
+            memcache.delete("entry:" + entry.slug)
+        incr_counter("generation")
+        record_change()
+        if cursor:
+            self.redirect("/backfill/thumbnails?" +
+                          urllib.urlencode({"cursor": cursor}))
+            return
+        self.write("Done")
+
+
+class WarmupHandler(BaseHandler):
+    # App Engine's warmup request, loads the per-instance indexes before the
+    # instance gets real traffic
+    def get(self):
+        self.get_entry_index()
+        slug_filter.rebuild(get_counter("slugs_version"))
+
+
+class BackfillKeysHandler(BaseHandler):
+    # One-off job re-keying entries saved before entries were keyed by their
+    # slug, a batch per request like BackfillThumbnailsHandler
+    @administrator
+    def get(self):
+        try:
+            (entries, cursor) = self.storage.rekey(20,
+                self.get_argument("cursor", None))
+        except storage.BadCursorError:
+            raise tornado.web.HTTPError(400)
+        for (old_key, entry) in entries:
+            invalidate_entry(entry, old_key=old_key)
+        if cursor:
+            self.redirect("/backfill/keys?" +
+                          urllib.urlencode({"cursor": cursor}))
+            return
+        self.write("Done")
+
+
+class BackfillTagsHandler(BaseHandler):
+    # One-off job building the Tag records for entries saved before they were
+    # maintained, safe to run again to repair them
+    @administrator
+    def get(self):
+        self.storage.rebuild_tags()
+        incr_counter("generation")
+        record_change()
+        self.write("Done")
+
+
+class BackfillSummariesHandler(BaseHandler):
+    # One-off job building the EntrySummary records for entries saved before
+    # they were maintained, safe to run again to repair them
+    @administrator
+    def get(self):
+        self.storage.rebuild_summaries()
+        self.write("Done")
+
+
+def local_path(url):
+    # The url when it is a path on this site, else the home page. Browsers
+    # read "//host" and "/\\host" as other sites, and drop tabs and newlines
+    # before they look
+    parsed = urlparse.urlsplit(url)
+    if parsed.scheme or parsed.netloc or not url.startswith("/") or \
+            url.startswith(("//", "/\\")) or \
+            any(ord(c) <= 32 for c in url):
+        return "/"
+    return url
+
+
+class LoginHandler(BaseHandler):
+    # Standalone only, App Engine has its own sign-in pages
+    def get(self):
+        self.render("login.html",
+                    next=local_path(self.get_argument("next", "/")),
+                    failed=False)
+
+    def post(self):
+        auth = self.settings["auth"]
+        next = local_path(self.get_argument("next", "/"))
+        if not auth.check_password(self.get_argument("password", "")):
+            self.set_status(403)
+            self.render("login.html", next=next, failed=True)
+            return
+        auth.sign_in(self)
+        self.redirect(next)
+
+
+class LogoutHandler(BaseHandler):
+    def get(self):
+        self.settings["auth"].sign_out(self)
+        self.redirect(local_path(self.get_argument("next", "/")))
+
+
 class OldEntryHandler(BaseHandler):
     @tornado.web.removeslash
     def get(self, slug):
@@ -315,76 +1246,158 @@ class OldEntryHandler(BaseHandler):
         
 
 class TagHandler(BaseHandler):
+    PAGE_ARGUMENTS = BaseHandler.PAGE_ARGUMENTS + ("cursor",)
+
     @tornado.web.removeslash
+    @tornado.gen.coroutine
     def get(self, tag):
-        q = db.Query(Entry).filter("hidden =", False).filter("tags =", tag)
-        q.order("-published")
-        self.render("tag.html", entries=q, tag=tag)
+        # Tags are made up by whoever requests them, only those with entries
+        # get a counter and cached pages
+        if not self.get_entry_index().has_tag(tag):
+            self.render_not_found()
+            return
+        if self.check_not_modified():
+            return
+        generation = get_counter("tag_generation:" + tag)
+        list_entries = functools.partial(self.list_by_tag, tag)
+        limit = self.application.settings.get("num_tag", 20)
+        cursor = self.get_cursor()
+        format = self.get_argument("format", None)
+        if format == "atom" and not cursor:
+            link = "http://" + self.request.host + "/t/" + tag
+            cache_key = "tag_feed:%s:%s:%s:%s" % (APP_VERSION,
+                self.request.host, tag, generation)
+            feed = memcache.get(cache_key)
+            if feed is None:
+                (entries, next_cursor) = yield self.run_blocking(
+                    self.get_cached_entries, "tag_entries:" + tag,
+                    list_entries, limit, generation=generation)
+                feed = self.render_feed(entries, link) if entries else ""
+                memcache.add(cache_key, feed)
+            if feed:
+                self.finish_feed(feed, link)
+                return
+        if format:
+            (entries, next_cursor) = yield self.run_blocking(
+                self.get_cached_entries, "tag_entries:" + tag, list_entries,
+                limit, cursor, generation=generation)
+        else:
+            (entries, next_cursor) = self.get_summaries(functools.partial(
+                self.get_entry_index().list_by_tag, tag), limit, cursor)
+        # The page has the sidebar too, so it goes with the content generation
+        # rather than the tag's
+        self.render_cached("tag:%s:%s:%s" % (tag,
+            self.get_content_version()[0], cursor), "tag.html",
+            entries=entries, tag=tag, cursor=next_cursor)
 
 
 class CatchAllHandler(BaseHandler):
     def __init__(self, *args, **kwargs):
         BaseHandler.__init__(self, *args, **kwargs)
         self.entry = None
+
+    @tornado.gen.coroutine
+    def prepare(self):
+        yield BaseHandler.prepare(self)
         slug = self.request.path[1:]
         if slug:
-            self.entry = db.Query(Entry).filter("slug =", slug).get()
+            self.entry = yield self.run_blocking(self.find_entry, slug)
+
+    def find_entry(self, slug):
+        if slug in slug_filter:
+            return self.get_entry_by_slug(slug)
+        return memcache.get("entry:" + slug)
 
     @tornado.web.removeslash
     def get(self):
         if self.entry:
-            return self.render("entry.html", entry=self.entry,
-                               entries=[self.entry])
-        self.set_status(404)
-        self.render("404.html")
+            if self.check_not_modified():
+                return
+            cache_key = "entry:%s:%s:%s" % (self.entry.slug,
+                self.entry.updated.isoformat(), self.get_content_version()[0])
+            return self.render_cached(cache_key, "entry.html",
+                entry=self.entry, entries=[self.entry])
+        self.render_not_found()
+
+    def get_return_uri(self):
+        return BaseHandler.get_return_uri(self) if self.entry else "/"
 
     def head(self):
         if not self.entry:
             self.set_status(404)
 
 
-class EntryModule(tornado.web.UIModule):
-    def render(self, entry, show_comments=False):
+class CachedModule(tornado.web.UIModule):
+    # A UI module whose output depends on nothing but what fragment_key
+    # returns for its arguments, rendered once per key per instance
+    def render(self, *args, **kwargs):
+        cache_key = self.fragment_key(*args, **kwargs)
+        html = fragment_cache.get(cache_key)
+        if html is None:
+            html = self.render_fragment(*args, **kwargs)
+            fragment_cache.set(cache_key, html)
+        return html
+
+
+class EntryModule(CachedModule):
+    def fragment_key(self, entry, show_comments=False, excerpt=False):
+        # The admin links only show for admins, and the like button and
+        # comments link to the entry on the requested host. Backfills change
+        # the excerpt and reading time without changing updated
+        return "entry:%s:%s:%s:%s:%s:%s:%s:%s:%s" % (str(entry.key()),
+            entry.updated.isoformat(), self.locale.code, show_comments,
+            excerpt, self.handler.get_viewer_class() == "admin",
+            self.request.host, entry.reading_time,
+            zlib.crc32(tornado.escape.utf8(entry.excerpt or "")))
+
+    def render_fragment(self, entry, show_comments=False, excerpt=False):
         self.show_comments = show_comments
+        body = entry.body
+        if excerpt and entry.excerpt is not None:
+            body = entry.excerpt
         return self.render_string("modules/entry.html", entry=entry,
-            show_comments=show_comments)
+            show_comments=show_comments, body=body,
+            truncated=body != entry.body)
 
 class MediaRSSModule(tornado.web.UIModule):
     def render(self, entry):
-        soup = BeautifulSoup.BeautifulSoup(entry.body,
-            parseOnlyThese=BeautifulSoup.SoupStrainer("img"))
-        imgs = soup.findAll("img")
-        thumbnails = []
-        for img in imgs:
-            if "nomediarss" in img.get("class", "").split():
-                continue
-            thumbnails.append({
-                "url": img["src"],
-                "title": img.get("title", img.get("alt", "")),
-                "width": img.get("width", ""),
-                "height": img.get("height", ""),
-            })
+        thumbnails = entry.thumbnails
+        if thumbnails is None:
+            thumbnails = mediarss.extract_thumbnails(entry.body)
         return self.render_string("modules/mediarss.html", entry=entry,
             thumbnails=thumbnails) 
 
 
-class EntrySmallModule(tornado.web.UIModule):
-    def render(self, entry, show_date=False):
+class EntrySmallModule(CachedModule):
+    # Gets entries as well as entry index records, which have the slug and
+    # updated time but no key() method
+    def fragment_key(self, entry, show_date=False):
+        return "entry_small:%s:%s:%s:%s" % (entry.slug,
+            entry.updated.isoformat(), self.locale.code, show_date)
+
+    def render_fragment(self, entry, show_date=False):
         return self.render_string("modules/entry-small.html", entry=entry,
             show_date=show_date)
 
 
 class RecentEntriesModule(tornado.web.UIModule):
     def render(self):
-        limit = self.handler.application.settings.get("num_home", 5)
-        cache_key = 'home_entries:%s:%s' % (None, limit)
-        cached_data = memcache.get(cache_key)
-        if cached_data:
-            (entries, new_cursor) = cached_data
-        else:
-            q = db.Query(Entry).filter("hidden =", False).order("-published")
-            entries = q.fetch(limit=limit)
-        return self.render_string("modules/recententries.html", entries=entries)
+        return self.render_string("modules/recententries.html",
+            entries=self.handler.get_recent_entries())
+
+
+class TagCloudModule(tornado.web.UIModule):
+    def render(self):
+        counts = self.handler.get_tag_counts()
+        if not counts:
+            return ""
+        low = min(count for (tag, count) in counts)
+        high = max(count for (tag, count) in counts)
+        tags = []
+        for (tag, count) in sorted(counts):
+            weight = 1 + 4 * (count - low) // (high - low) if high > low else 3
+            tags.append((tag, count, weight))
+        return self.render_string("modules/tagcloud.html", tags=tags)
 
 
 class NavigationModule(tornado.web.UIModule):
@@ -396,12 +1409,114 @@ class NavigationModule(tornado.web.UIModule):
         return self.render_string("modules/navigation.html", previous=previous)
 
 
+def anonymous_cache_key(host, uri, generation):
+    # Signed-out viewers all get the same page for a URI, as long as there is
+    # only the one locale to pick from
+    locales = tornado.locale.get_supported_locales()
+    if len(locales) != 1:
+        return None
+    return "anonymous:%s:%s:%s:%s:%s" % (APP_VERSION, generation,
+                                         list(locales)[0], host, uri)
+
+
+class AnonymousResponse(object):
+    # A response to a signed-out viewer as cached by
+    # BaseHandler.cache_anonymous_response, sent again as WSGI
+    def __init__(self, status, headers, page, etag, last_modified):
+        self.status = status
+        self.headers = headers
+        self.page = page
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def send(self, environ, start_response):
+        if self.etag and is_fresh(environ.get("HTTP_IF_NONE_MATCH"),
+                                  environ.get("HTTP_IF_MODIFIED_SINCE"),
+                                  self.etag, self.last_modified):
+            start_response("304 Not Modified", [
+                (name, value) for (name, value) in self.headers
+                if name in ("Last-Modified", "Vary")] + [("Etag", self.etag)])
+            return []
+        (encoding, data) = self.page.negotiate(
+            environ.get("HTTP_ACCEPT_ENCODING"))
+        headers = list(self.headers)
+        if self.etag:
+            headers.append(("Etag", encoded_etag(self.etag, encoding)
+                            if encoding else self.etag))
+        if encoding:
+            headers.append(("Content-Encoding", encoding))
+        headers.append(("Content-Length", str(len(data))))
+        start_response("%d %s" % (self.status, httplib.responses[self.status]),
+                       headers)
+        return [data]
+
+
+class AnonymousFastPath(object):
+    # WSGI middleware answering GET requests without a sign-in cookie from the
+    # responses cached for earlier signed-out viewers, before Tornado builds a
+    # handler. Those requests never look up the user or create a login URL;
+    # the cached page already has the login link for its URI
+    AUTH_COOKIE_RE = re.compile(
+        r"(?:^|;)\s*(?:ACSID|SACSID|dev_appserver_login)=")
+
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        if environ["REQUEST_METHOD"] != "GET" or \
+                self.AUTH_COOKIE_RE.search(environ.get("HTTP_COOKIE", "")):
+            return self.application(environ, start_response)
+        uri = urllib.quote(environ.get("SCRIPT_NAME", "")) + \
+            urllib.quote(environ.get("PATH_INFO", ""))
+        if environ.get("QUERY_STRING"):
+            uri += "?" + environ["QUERY_STRING"]
+        cache_key = anonymous_cache_key(environ.get("HTTP_HOST", "127.0.0.1"),
+                                        uri, get_content_version()[0])
+        response = memcache.get(cache_key) if cache_key else None
+        if response is None:
+            return self.application(environ, start_response)
+        return response.send(environ, start_response)
+
+
 settings = {
     "autoescape": None,
     "blog_author": "Benjamin Golub",
     "blog_title": "Benjamin Golub",
     "fb_admins": "15500414",
     "fb_app_id": "143871635676545",
+    # Each endpoint is requested with its args formatted with the feed, home,
+    # sup_id and title of the blog. Point these at a local server to test
+    "ping_endpoints": [
+        {
+            "url": "http://blogsearch.google.com/ping",
+            "args": {
+                "name": "%(title)s",
+                "url": "%(home)s",
+                "changesURL": "%(feed)s",
+            },
+        },
+        {
+            "url": "http://friendfeed.com/api/public-sup-ping",
+            "args": {
+                "url": "%(feed)s",
+                "supid": "%(sup_id)s",
+            },
+        },
+        {
+            "url": "http://www.feedburner.com/fb/a/pingSubmit",
+            "args": {
+                "bloglink": "%(home)s",
+            },
+        },
+        {
+            "url": "http://pubsubhubbub.appspot.com/",
+            "method": "POST",
+            "args": {
+                "hub.mode": "publish",
+                "hub.url": "%(feed)s",
+            },
+        },
+    ],
     "debug": os.environ.get("SERVER_SOFTWARE", "").startswith("Development/"),
     "template_path": os.path.join(os.path.dirname(__file__), "templates"),
     "ui_modules": {
@@ -409,22 +1524,53 @@ settings = {
         "EntrySmall": EntrySmallModule,
         "MediaRSS": MediaRSSModule,
         "RecentEntries": RecentEntriesModule,
+        "TagCloud": TagCloudModule,
         "Navigation": NavigationModule,
     },
+    "auth": standalone.PasswordAuth(
+        os.environ.get("BLOG_ADMIN_NICKNAME", "admin"),
+        os.environ.get("BLOG_ADMIN_PASSWORD")) if STANDALONE else
+        AppEngineAuth(),
+    # Secure cookies are only used by standalone sign-in. Without a
+    # configured secret, signing in lasts until the server restarts
+    "cookie_secret": os.environ.get("BLOG_COOKIE_SECRET") or
+        os.urandom(32).encode("hex"),
+    "static_handler_class": StaticHandler,
+    "static_path": os.path.join(os.path.dirname(__file__), "static"),
+    "storage": backend,
     "xsrf_cookies": True,
 }
 
-application = tornado.web.Application([
+handlers = [
     (r"/", HomeHandler),
     (r"/about/?", AboutHandler),
     (r"/archive/?", ArchiveHandler),
+    (r"/backfill/keys", BackfillKeysHandler),
+    (r"/backfill/summaries", BackfillSummariesHandler),
+    (r"/backfill/tags", BackfillTagsHandler),
+    (r"/backfill/thumbnails", BackfillThumbnailsHandler),
     (r"/compose", ComposeHandler),
     (r"/delete", DeleteHandler),
     (r"/e/([\w-]+)/?", OldEntryHandler),
     (r"/feed/?", tornado.web.RedirectHandler, {"url": "/?format=atom"}),
     (r"/hide", HideHandler),
     (r"/t/([\w-]+)/?", TagHandler),
-    (r".*", CatchAllHandler),
-], **settings)
+]
+if STANDALONE:
+    # Pings are sent from the IOLoop instead, see schedule_pings
+    handlers += [
+        (r"/login", LoginHandler),
+        (r"/logout", LogoutHandler),
+    ]
+else:
+    # App Engine only routes /_ah/ requests of its own to the application
+    handlers += [
+        (r"/_ah/warmup", WarmupHandler),
+        (r"/tasks/ping", PingHandler),
+    ]
+handlers.append((r".*", CatchAllHandler))
 
-application = tornado.wsgi.WSGIAdapter(application)
+# server.py serves tornado_application itself, App Engine gets the WSGI
+# application
+tornado_application = tornado.web.Application(handlers, **settings)
+application = AnonymousFastPath(tornado.wsgi.WSGIAdapter(tornado_application))
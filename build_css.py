@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#
+# Builds static/css/base.min.css, the stylesheet the templates link, from
+# static/css/base.css by inlining the images it references as data URIs and
+# minifying the result, so a page needs one stylesheet request and no icon
+# requests. Run it after changing base.css or any of its images:
+#
+#   python build_css.py
+
+import base64
+import mimetypes
+import os
+import re
+
+CSS_PATH = os.path.join(os.path.dirname(__file__), "static", "css")
+
+# Strings and comments are matched first so nothing inside a string is ever
+# treated as whitespace or as a url()
+_TOKEN_RE = re.compile(r"""
+    (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<comment>/\*.*?\*/)
+  | (?P<space>\s+)
+  | (?P<other>[^"'/\s]+|/)
+""", re.S | re.X)
+
+_URL_RE = re.compile(r"""
+    url\(\s*(?P<quote>["']?)(?P<url>[^"')]+)(?P=quote)\s*\)
+""", re.X)
+
+_PUNCTUATION = "{}:;,>"
+
+
+def inline_images(css, path):
+    def data_uri(match):
+        url = match.group("url")
+        if ":" in url or url.startswith("/"):
+            return match.group(0)
+        filename = os.path.normpath(os.path.join(path, url))
+        with open(filename, "rb") as f:
+            data = f.read()
+        return "url(data:%s;base64,%s)" % (mimetypes.guess_type(filename)[0],
+                                           base64.b64encode(data))
+    return _URL_RE.sub(data_uri, css)
+
+
+def minify(css):
+    parts = []
+    pending_space = False
+    for match in _TOKEN_RE.finditer(css):
+        kind = match.lastgroup
+        if kind == "comment":
+            continue
+        if kind == "space":
+            pending_space = True
+            continue
+        text = match.group(0)
+        if pending_space and parts and parts[-1][-1] not in _PUNCTUATION and \
+                text[0] not in _PUNCTUATION:
+            parts.append(" ")
+        pending_space = False
+        parts.append(text)
+    return "".join(parts).replace(";}", "}") + "\n"
+
+
+def main():
+    with open(os.path.join(CSS_PATH, "base.css")) as f:
+        css = f.read()
+    css = minify(inline_images(css, CSS_PATH))
+    with open(os.path.join(CSS_PATH, "base.min.css"), "w") as f:
+        f.write(css)
+    print "Wrote base.min.css, %d bytes" % len(css)
+
+
+if __name__ == "__main__":
+    main()
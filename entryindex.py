@@ -0,0 +1,101 @@
+import bisect
+import calendar
+
+from storage import BadCursorError
+
+
+class EntryRecord(object):
+    # Everything the listings need to know about an entry except its body,
+    # enough for modules/entry-small.html to render a record directly
+    __slots__ = ("key", "slug", "title", "published", "updated", "tags",
+                 "hidden")
+
+    def __init__(self, key, slug, title, published, updated, tags, hidden):
+        self.key = key
+        self.slug = slug
+        self.title = title
+        self.published = published
+        self.updated = updated
+        self.tags = tags
+        self.hidden = hidden
+
+
+def timestamp(value):
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+class EntryIndex(object):
+    # An immutable, in-memory listing of the visible entries, newest first.
+    # Pages start from a binary search on (published, key) so cursors stay
+    # valid across rebuilds, and each tag is a bitmap over the positions of
+    # its entries in that order. Build a new index rather than changing one
+    def __init__(self, rows, version=None):
+        records = [EntryRecord(*row) for row in rows]
+        records = [record for record in records if not record.hidden]
+        records.sort(key=lambda record: (-timestamp(record.published),
+                                         record.key))
+        self.version = version
+        self.records = records
+        self.positions = [(-timestamp(record.published), record.key)
+                          for record in records]
+        self.bitmaps = {}
+        for (position, record) in enumerate(records):
+            for tag in record.tags:
+                self.bitmaps[tag] = self.bitmaps.get(tag, 0) | (1 << position)
+
+    def __len__(self):
+        return len(self.records)
+
+    def has_tag(self, tag):
+        return tag in self.bitmaps
+
+    def rows(self):
+        return [(record.key, record.slug, record.title, record.published,
+                 record.updated, record.tags, record.hidden)
+                for record in self.records]
+
+    def replace(self, keys, row, version):
+        # A new index without the entries in keys, plus row if it is given
+        rows = [existing for existing in self.rows() if existing[0] not in keys]
+        if row:
+            rows.append(row)
+        return EntryIndex(rows, version)
+
+    def start(self, cursor):
+        if not cursor:
+            return 0
+        try:
+            (published, key) = cursor.split(",", 1)
+            position = (-float(published), key)
+        except ValueError:
+            raise BadCursorError(cursor)
+        return bisect.bisect_right(self.positions, position)
+
+    def cursor(self, record):
+        return "%r,%s" % (timestamp(record.published), record.key)
+
+    def normalize(self, cursor):
+        # The cursor this index hands out for the page cursor starts, None for
+        # the first page. Raises BadCursorError like start
+        start = self.start(cursor)
+        return self.cursor(self.records[start - 1]) if start else None
+
+    def list_visible(self, limit, cursor=None):
+        start = self.start(cursor)
+        end = start + limit if limit is not None else len(self.records)
+        records = self.records[start:end]
+        if end >= len(self.records) or not records:
+            return (records, None)
+        return (records, self.cursor(records[-1]))
+
+    def list_by_tag(self, tag, limit=None, cursor=None):
+        start = self.start(cursor)
+        bitmap = self.bitmaps.get(tag, 0) >> start << start
+        records = []
+        while bitmap and (limit is None or len(records) < limit):
+            lowest = bitmap & -bitmap
+            records.append(self.records[lowest.bit_length() - 1])
+            bitmap ^= lowest
+        if not bitmap or not records:
+            return (records, None)
+        return (records, self.cursor(records[-1]))
@@ -0,0 +1,69 @@
+import math
+import re
+
+# Roughly how fast people read, in words per minute
+READING_SPEED = 200
+
+# The body as a sequence of comments, raw text elements, tags and text. Only
+# text counts towards the words, and the excerpt is only ever cut between
+# tokens or inside text, so it never ends in the middle of a tag
+_TOKEN_RE = re.compile(r"""
+    (?P<more><!--\s*more\s*-->)
+  | <!--.*?-->
+  | <(?P<raw>script|style|textarea)\b.*?</(?P=raw)\s*>
+  | <(?P<close>/)?(?P<tag>[a-zA-Z][^\s/>]*)
+      (?:[^>"']|"[^"]*"|'[^']*')*?(?P<selfclose>/)?>
+  | (?P<text>[^<]+)
+  | <
+""", re.I | re.S | re.X)
+
+_WORD_RE = re.compile(r"\S+")
+
+_VOID_ELEMENTS = frozenset([
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta",
+    "param", "source", "track", "wbr",
+])
+
+
+def extract_excerpt(body, words):
+    # Returns (excerpt, word count) where the excerpt is the body up to its
+    # <!--more--> marker or its first words words, whichever comes first, with
+    # the elements open at that point closed. The excerpt is the body itself
+    # when neither cuts it short
+    count = 0
+    cut = None
+    more = None
+    open_tags = []
+    for match in _TOKEN_RE.finditer(body):
+        text = match.group("text")
+        if text is not None:
+            for word in _WORD_RE.finditer(text):
+                count += 1
+                if cut is None and count == words:
+                    cut = match.start() + word.end()
+            continue
+        if cut is not None:
+            continue
+        if match.group("more") is not None:
+            cut = match.start()
+            more = match.group("more")
+        elif match.group("tag") is not None:
+            tag = match.group("tag").lower()
+            if match.group("close"):
+                if tag in open_tags:
+                    index = len(open_tags) - 1 - open_tags[::-1].index(tag)
+                    del open_tags[index:]
+            elif tag not in _VOID_ELEMENTS and not match.group("selfclose"):
+                open_tags.append(tag)
+    # Cutting after the last word, or at a marker with nothing after it, would
+    # leave out nothing worth a "continue reading"
+    if cut is None or (count <= words if not more else
+                       not body[cut:].replace(more, "", 1).strip()):
+        return (body, count)
+    closing = "".join("</%s>" % tag for tag in reversed(open_tags))
+    return (body[:cut].rstrip() + closing, count)
+
+
+def reading_time(word_count):
+    # In whole minutes, and never less than one
+    return max(1, int(math.ceil(word_count / float(READING_SPEED))))
@@ -0,0 +1,54 @@
+import HTMLParser
+import re
+
+# A single pass over the body that only understands as much HTML as it takes
+# to find <img> tags: comments and raw text elements are matched (and skipped)
+# as whole tokens so images inside them aren't picked up, everything else
+# between images is never looked at
+_TOKEN_RE = re.compile(r"""
+    <!--.*?-->
+  | <(?P<raw>script|style|textarea)\b.*?</(?P=raw)\s*>
+  | <img(?=[\s/>])(?P<attrs>(?:[^>"']|"[^"]*"|'[^']*')*)>
+""", re.I | re.S | re.X)
+
+_ATTR_RE = re.compile(r"""
+    (?P<name>[^\s/>"'=]+)
+    (?:\s*=\s*(?:"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<bare>[^\s"'>]*)))?
+""", re.X)
+
+_unescape = HTMLParser.HTMLParser().unescape
+
+
+def parse_attrs(text):
+    attrs = {}
+    for match in _ATTR_RE.finditer(text):
+        name = match.group("name").lower()
+        for group in ("dq", "sq", "bare"):
+            value = match.group(group)
+            if value is not None:
+                break
+        else:
+            # Valueless attributes are reported with their name as the value,
+            # the way BeautifulSoup (and SGMLParser) did
+            value = name
+        if "&" in value:
+            value = _unescape(value)
+        attrs[name] = value
+    return attrs
+
+
+def extract_thumbnails(body):
+    thumbnails = []
+    for match in _TOKEN_RE.finditer(body):
+        if match.group("attrs") is None:
+            continue
+        img = parse_attrs(match.group("attrs"))
+        if "src" not in img or "nomediarss" in img.get("class", "").split():
+            continue
+        thumbnails.append({
+            "url": img["src"],
+            "title": img.get("title", img.get("alt", "")),
+            "width": img.get("width", ""),
+            "height": img.get("height", ""),
+        })
+    return thumbnails
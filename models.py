@@ -0,0 +1,87 @@
+import contextlib
+import datetime
+import json
+import threading
+
+from google.appengine.ext import db
+
+
+class JSONProperty(db.TextProperty):
+    data_type = object
+
+    def get_value_for_datastore(self, model_instance):
+        value = super(JSONProperty, self).get_value_for_datastore(
+            model_instance)
+        if value is None:
+            return None
+        return db.Text(json.dumps(value, separators=(",", ":")))
+
+    def make_value_from_datastore(self, value):
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def validate(self, value):
+        return value
+
+
+class UpdatedProperty(db.DateTimeProperty):
+    # auto_now, except for what the current thread saves in untouched(). The
+    # property belongs to the model class, which every request shares, so
+    # switching auto_now off would let other requests' saves through untouched
+    def __init__(self, *args, **kwargs):
+        super(UpdatedProperty, self).__init__(*args, **kwargs)
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def untouched(self):
+        self.local.untouched = True
+        try:
+            yield
+        finally:
+            self.local.untouched = False
+
+    def get_value_for_datastore(self, model_instance):
+        if getattr(self.local, "untouched", False):
+            return db.Property.get_value_for_datastore(self, model_instance)
+        return super(UpdatedProperty, self).get_value_for_datastore(
+            model_instance)
+
+
+class Entry(db.Model):
+    author = db.UserProperty()
+    title = db.StringProperty(required=True)
+    slug = db.StringProperty(required=True)
+    body = db.TextProperty(required=True)
+    published = db.DateTimeProperty(auto_now_add=True)
+    updated = UpdatedProperty(auto_now=True)
+    tags = db.ListProperty(db.Category)
+    hidden = db.BooleanProperty(default=False)
+    # Media RSS thumbnails, extracted from the body when it is saved. None for
+    # entries saved before this property existed until the backfill runs
+    thumbnails = JSONProperty()
+    # Likewise computed from the body when it is saved. The excerpt is the
+    # body up to <!--more--> or the first excerpt_words words
+    excerpt = db.TextProperty()
+    word_count = db.IntegerProperty(indexed=False)
+    reading_time = db.IntegerProperty(indexed=False)
+
+
+class Tag(db.Model):
+    # Keyed by the tag, maintained by DatastoreStorage. The keys of the visible
+    # entries with the tag are in published order, published is the parallel
+    # list of their dates
+    entry_keys = db.ListProperty(db.Key, indexed=False)
+    published = db.ListProperty(datetime.datetime, indexed=False)
+    count = db.IntegerProperty(default=0)
+
+
+class EntrySummary(db.Model):
+    # Keyed by the entry's key, maintained by DatastoreStorage. An Entry
+    # without its body, for building the entry index
+    slug = db.StringProperty(indexed=False)
+    title = db.StringProperty(indexed=False)
+    published = db.DateTimeProperty(indexed=False)
+    updated = db.DateTimeProperty(indexed=False)
+    tags = db.StringListProperty(indexed=False)
+    hidden = db.BooleanProperty(indexed=False)
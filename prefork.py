@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+#
+# Runs the standalone blog of server.py in several worker processes, one per
+# core by default, all accepting connections on the same listening socket:
+#
+#   BLOG_STORAGE=sqlite:/path/to/blog.db BLOG_ADMIN_PASSWORD=... \
+#       python prefork.py --port=8888 --hostname=example.com
+#
+# Workers that die are restarted. Each worker imports the blog after it is
+# forked and warms its caches by requesting --warm_paths from itself before it
+# accepts any connection. Workers cache what they render on their own; only
+# the counters that version cached data are shared, see standalone.Memcache.
+#
+# SIGHUP reloads: workers running the code on disk replace the running ones
+# one at a time, so the others keep serving, and each old worker is only
+# retired once its replacement is warm. Retired workers stop accepting
+# connections and get --grace seconds to finish the requests they have.
+# Changes to this file, server.py or standalone.py need a restart instead.
+
+import errno
+import logging
+import os
+import signal
+import standalone
+import time
+import tornado.gen
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.options
+import tornado.process
+
+from server import make_server
+from tornado.options import define, options
+
+define("workers", default=0, help="worker processes, 0 for one per core",
+       type=int)
+define("grace", default=10, type=int,
+       help="seconds retired workers get to finish their requests")
+define("hostname", default=None,
+       help="the blog's host name, whose pages and feeds workers warm")
+define("warm_paths", default="/,/?format=atom,/archive",
+       help="comma-separated paths workers request before serving")
+
+# Workers that die sooner than this many seconds after they were started are
+# restarted after as long, so a broken deploy doesn't fork in a tight loop
+MIN_UPTIME = 1
+
+
+def retry_interrupted(function, *args):
+    # Python 2 doesn't retry system calls interrupted by our signal handlers
+    while True:
+        try:
+            return function(*args)
+        except (IOError, OSError) as e:
+            if e.errno != errno.EINTR:
+                raise
+
+
+@tornado.gen.coroutine
+def warm(application):
+    # Requests warm_paths through a private server on this worker's
+    # application: that compiles the templates and fills the entry index and
+    # the rendered pages and feeds of anonymous visitors. Rendered pages are
+    # cached per host, so those are only warmed with --hostname
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    server = tornado.httpserver.HTTPServer(application)
+    server.add_sockets(sockets)
+    url = "http://127.0.0.1:%d" % sockets[0].getsockname()[1]
+    headers = {"Host": options.hostname} if options.hostname else None
+    client = tornado.httpclient.AsyncHTTPClient()
+    try:
+        for path in options.warm_paths.split(","):
+            response = yield client.fetch(url + path.strip(), headers=headers,
+                                          raise_error=False)
+            if response.code >= 500:
+                logging.warning("Warming %s failed: %s", path,
+                                response.code)
+    finally:
+        server.stop()
+
+
+def run_worker(sockets, counters, ready_fd):
+    # The launcher takes care of these
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server = make_server()
+    import blog
+    blog.memcache.share(counters)
+    io_loop = tornado.ioloop.IOLoop.current()
+    retiring = []
+
+    @tornado.gen.coroutine
+    def start():
+        try:
+            yield warm(blog.tornado_application)
+        except Exception:
+            logging.exception("Warming caches failed")
+        if retiring:
+            return
+        server.add_sockets(sockets)
+        try:
+            os.write(ready_fd, "1")
+        except OSError:
+            # Nobody waits on workers that are restarted
+            pass
+        os.close(ready_fd)
+
+    def retire():
+        retiring.append(True)
+        server.stop()
+        io_loop.call_later(options.grace, io_loop.stop)
+
+    def stop(signum, frame):
+        io_loop.add_callback_from_signal(retire)
+    signal.signal(signal.SIGTERM, stop)
+    io_loop.add_callback(start)
+    io_loop.start()
+
+
+class Supervisor(object):
+    def __init__(self, sockets, count):
+        self.sockets = sockets
+        self.count = count
+        # Forked workers share these, so they are created before any is
+        self.counters = standalone.SharedCounters()
+        # pid -> (slot, start time) of the workers serving, and the pids of
+        # those told to stop
+        self.workers = {}
+        self.retired = set()
+        self.reloading = False
+        self.stopping = False
+
+    def spawn(self, slot):
+        # Returns the worker's pid and a pipe it writes to once it accepts
+        # connections
+        (read_fd, write_fd) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            try:
+                run_worker(self.sockets, self.counters, write_fd)
+            except BaseException:
+                logging.exception("Worker %d failed", os.getpid())
+                os._exit(1)
+            os._exit(0)
+        os.close(write_fd)
+        self.workers[pid] = (slot, time.time())
+        return (pid, read_fd)
+
+    def wait_ready(self, read_fd):
+        # Whether the worker got as far as accepting connections
+        try:
+            return retry_interrupted(os.read, read_fd, 1) == "1"
+        finally:
+            os.close(read_fd)
+
+    def retire(self, pid):
+        self.workers.pop(pid, None)
+        self.retired.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def reap(self, pid, status):
+        if pid in self.retired:
+            self.retired.discard(pid)
+            return
+        if pid not in self.workers:
+            return
+        (slot, started) = self.workers.pop(pid)
+        logging.warning("Worker %d exited with status %d, restarting", pid,
+                        status)
+        if time.time() - started < MIN_UPTIME:
+            time.sleep(MIN_UPTIME)
+        os.close(self.spawn(slot)[1])
+
+    def reload(self):
+        logging.info("Reloading %d workers", len(self.workers))
+        for (pid, (slot, started)) in sorted(self.workers.items(),
+                                             key=lambda item: item[1]):
+            if self.stopping:
+                return
+            (new_pid, read_fd) = self.spawn(slot)
+            if not self.wait_ready(read_fd):
+                # Keep the old code running rather than restarting the
+                # broken one over and over
+                logging.error("New worker failed to start, reload aborted")
+                self.retire(new_pid)
+                return
+            self.retire(pid)
+
+    def run(self):
+        def reload(signum, frame):
+            self.reloading = True
+
+        def stop(signum, frame):
+            self.stopping = True
+        signal.signal(signal.SIGHUP, reload)
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        # Nothing is served until the first workers are ready, so they all
+        # warm at once
+        pipes = [self.spawn(slot) for slot in xrange(self.count)]
+        if not all([self.wait_ready(read_fd) for (pid, read_fd) in pipes]):
+            self.stop()
+            raise SystemExit("Workers failed to start")
+        logging.info("%d workers ready", self.count)
+        while not self.stopping:
+            if self.reloading:
+                self.reloading = False
+                self.reload()
+                continue
+            (pid, status) = retry_interrupted(os.waitpid, -1, os.WNOHANG)
+            if pid:
+                self.reap(pid, status)
+            else:
+                # Signals cut this short
+                time.sleep(1)
+        self.stop()
+
+    def stop(self):
+        for pid in list(self.workers):
+            self.retire(pid)
+        while self.retired:
+            try:
+                (pid, status) = retry_interrupted(os.wait)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                break
+            self.retired.discard(pid)
+
+
+def main():
+    tornado.options.parse_command_line()
+    # Workers must all sign cookies with the same secret
+    if not os.environ.get("BLOG_COOKIE_SECRET"):
+        os.environ["BLOG_COOKIE_SECRET"] = os.urandom(32).encode("hex")
+    sockets = tornado.netutil.bind_sockets(options.port, options.address)
+    Supervisor(sockets, options.workers or tornado.process.cpu_count()).run()
+
+
+if __name__ == "__main__":
+    main()
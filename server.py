@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+#
+# Serves the blog without App Engine, on Tornado's own HTTP server:
+#
+#   BLOG_STORAGE=sqlite:/path/to/blog.db BLOG_ADMIN_PASSWORD=... \
+#       python server.py --port=8888
+#
+# Memcache is replaced by an in-process cache, sign-in by the password in
+# BLOG_ADMIN_PASSWORD (set BLOG_COOKIE_SECRET too so signing in survives
+# restarts) and the task queue by pings scheduled on the IOLoop. Storage
+# calls run on a thread pool when the concurrent.futures backport is
+# installed, so a slow query doesn't hold up every other request.
+
+import os
+import tornado.httpserver
+import tornado.ioloop
+import tornado.options
+
+from tornado.options import define, options
+
+define("port", default=8888, help="port to listen on", type=int)
+define("address", default="", help="address to listen on")
+define("threads", default=4, help="storage threads, 0 for none", type=int)
+define("cache_size", default=64, help="megabytes of cached data per process", type=int)
+
+try:
+    import concurrent.futures
+except ImportError:
+    concurrent = None
+
+
+def make_server():
+    import blog
+    if not blog.STANDALONE:
+        raise SystemExit("server.py can't run inside the App Engine SDK")
+    if not (os.environ.get("BLOG_STORAGE") or "").startswith("sqlite:"):
+        raise SystemExit("Set BLOG_STORAGE to sqlite:<path>")
+    blog.memcache.max_size = options.cache_size * 1024 * 1024
+    application = blog.tornado_application
+    if options.threads and concurrent is not None:
+        application.settings["executor"] = \
+            concurrent.futures.ThreadPoolExecutor(options.threads)
+    return tornado.httpserver.HTTPServer(application, xheaders=True)
+
+
+def main():
+    tornado.options.parse_command_line()
+    server = make_server()
+    server.listen(options.port, options.address)
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
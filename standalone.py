@@ -0,0 +1,219 @@
+import collections
+import cPickle
+import hmac
+import mmap
+import multiprocessing
+import struct
+import threading
+import time
+import urllib
+import zlib
+
+
+class SharedCounters(object):
+    # Counters in memory shared by the workers prefork.py forks, created
+    # before forking. Names hash to a fixed number of slots and names that
+    # share a slot share a value, which only means that bumping one also
+    # invalidates whatever the other versions. Slot 0 counts every increment
+    # so workers can cheaply tell that anything changed
+    SLOTS = 4096
+
+    def __init__(self):
+        self.memory = mmap.mmap(-1, self.SLOTS * 8)
+        self.lock = multiprocessing.Lock()
+        # Seeded from the clock, like the blog seeds memcache counters, so
+        # values are never reused after a restart
+        seed = int(time.time() * 1000)
+        for slot in xrange(1, self.SLOTS):
+            struct.pack_into("q", self.memory, slot * 8, seed)
+
+    def offset(self, name):
+        return (1 + (zlib.crc32(name) & 0xffffffff) % (self.SLOTS - 1)) * 8
+
+    def get(self, name):
+        with self.lock:
+            return struct.unpack_from("q", self.memory, self.offset(name))[0]
+
+    def epoch(self):
+        with self.lock:
+            return struct.unpack_from("q", self.memory, 0)[0]
+
+    def incr(self, name, delta=1):
+        # Returns the new value and the new epoch
+        offset = self.offset(name)
+        with self.lock:
+            value = struct.unpack_from("q", self.memory, offset)[0] + delta
+            struct.pack_into("q", self.memory, offset, value)
+            epoch = struct.unpack_from("q", self.memory, 0)[0] + 1
+            struct.pack_into("q", self.memory, 0, epoch)
+        return (value, epoch)
+
+
+class Memcache(object):
+    # An in-process stand-in for the parts of App Engine's memcache API the
+    # blog uses. Values are pickled like memcache does, so callers get their
+    # own copies and can't change what is cached. Nothing expires: cached
+    # values are keyed so that stale ones are just never read again, and the
+    # least recently used go once the pickles take more than max_size bytes.
+    #
+    # Forked workers each have their own cache but share the counters named
+    # (by prefix) in counters through SharedCounters, see share(). Everything
+    # else is cached data, which a worker drops as soon as a counter changes
+    # anywhere
+    def __init__(self, counters=(), max_size=64 * 1024 * 1024):
+        self.data = collections.OrderedDict()
+        self.size = 0
+        self.max_size = max_size
+        # Reentrant as add and incr take it and then call set, which may
+        # take it to drop stale data
+        self.lock = threading.RLock()
+        self.counters = tuple(counters)
+        self.shared = None
+        self.epoch = None
+        self.local = threading.local()
+
+    def share(self, shared):
+        with self.lock:
+            self.clear()
+            self.shared = shared
+            self.epoch = shared.epoch()
+
+    def is_shared(self, key):
+        return self.shared is not None and key.startswith(self.counters)
+
+    def sync(self):
+        # Drops what was cached before the latest change to a shared counter
+        # and returns whether the calling thread had already seen that
+        # change. A thread that hadn't may be about to cache something it
+        # read from storage before the change, so it mustn't
+        if self.shared is None:
+            return True
+        epoch = self.shared.epoch()
+        seen = getattr(self.local, "epoch", None)
+        self.local.epoch = epoch
+        if epoch > self.epoch:
+            with self.lock:
+                if epoch > self.epoch:
+                    self.clear()
+                    self.epoch = epoch
+        return seen == epoch
+
+    def get(self, key):
+        if self.is_shared(key):
+            return self.shared.get(key)
+        self.sync()
+        with self.lock:
+            value = self.data.pop(key, None)
+            if value is None:
+                return None
+            self.data[key] = value
+        return cPickle.loads(value)
+
+    def get_multi(self, keys):
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set(self, key, value):
+        if not self.sync():
+            return False
+        value = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.delete(key)
+            self.data[key] = value
+            self.size += len(value)
+            while self.size > self.max_size:
+                self.size -= len(self.data.popitem(last=False)[1])
+        return True
+
+    def add(self, key, value):
+        if self.is_shared(key):
+            # Shared counters always exist
+            return False
+        with self.lock:
+            if key in self.data:
+                return False
+            return self.set(key, value)
+
+    def delete(self, key):
+        with self.lock:
+            value = self.data.pop(key, None)
+            if value is not None:
+                self.size -= len(value)
+        return True
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.size = 0
+
+    def incr(self, key, delta=1, initial_value=None):
+        if self.is_shared(key):
+            return self.incr_shared(key, delta)
+        with self.lock:
+            value = self.get(key)
+            if value is None:
+                if initial_value is None:
+                    return None
+                value = initial_value
+            self.set(key, value + delta)
+            return value + delta
+
+    def incr_shared(self, key, delta):
+        (value, epoch) = self.shared.incr(key, delta)
+        with self.lock:
+            # When nothing but this increment changed since the calling thread
+            # last looked, this worker's cache is as fresh as a single
+            # process' would be: the writer itself keeps it up to date
+            if self.epoch == getattr(self.local, "epoch", None) == epoch - 1:
+                self.epoch = epoch
+                self.local.epoch = epoch
+        return value
+
+    def offset_multi(self, mapping, initial_value=None):
+        return dict((key, self.incr(key, delta, initial_value))
+                    for (key, delta) in mapping.iteritems())
+
+
+class Administrator(object):
+    # Looks enough like an App Engine User for the handlers and templates
+    administrator = True
+
+    def __init__(self, nickname):
+        self._nickname = nickname
+
+    def nickname(self):
+        return self._nickname
+
+
+class PasswordAuth(object):
+    # Standalone sign-in: the only user is the administrator, who signs in at
+    # /login with the configured password and is remembered by a secure cookie
+    COOKIE = "administrator"
+
+    def __init__(self, nickname, password):
+        self.nickname = nickname
+        self.password = password
+
+    def check_password(self, password):
+        return bool(self.password) and hmac.compare_digest(
+            password.encode("utf-8"), self.password.encode("utf-8"))
+
+    def get_current_user(self, handler):
+        nickname = handler.get_secure_cookie(self.COOKIE)
+        return Administrator(nickname) if nickname else None
+
+    def sign_in(self, handler):
+        handler.set_secure_cookie(self.COOKIE, self.nickname, httponly=True)
+
+    def sign_out(self, handler):
+        handler.clear_cookie(self.COOKIE)
+
+    def create_login_url(self, dest_url):
+        return "/login?" + urllib.urlencode({"next": dest_url})
+
+    def create_logout_url(self, dest_url):
+        return "/logout?" + urllib.urlencode({"next": dest_url})
@@ -0,0 +1,631 @@
+import bisect
+import datetime
+import json
+import os
+import threading
+import uuid
+
+try:
+    from google.appengine.ext import db
+except ImportError:
+    db = None
+
+try:
+    import sqlite3
+except ImportError:
+    # Not in the App Engine sandbox, which only uses the datastore
+    sqlite3 = None
+
+
+class BadCursorError(ValueError):
+    pass
+
+
+def metadata(entry):
+    return (str(entry.key()), entry.slug, entry.title, entry.published,
+            entry.updated, list(entry.tags), entry.hidden)
+
+
+class Storage(object):
+    # Everything the handlers need from wherever entries are kept. Listing
+    # methods return (entries, cursor) where cursor is None once there is
+    # nothing left, and raise BadCursorError for cursors they didn't hand out
+    def new(self, **fields):
+        raise NotImplementedError()
+
+    def update(self, entry, **fields):
+        raise NotImplementedError()
+
+    def create(self, slug, **fields):
+        # Saves a new entry under slug, or slug with a random suffix if it is
+        # taken. Reserving the slug is atomic, so concurrent creates can't end
+        # up with the same one
+        candidate = slug
+        while True:
+            entry = self.insert(candidate, fields)
+            if entry:
+                return entry
+            candidate = slug + "-" + uuid.uuid4().hex[:2]
+
+    def insert(self, slug, fields):
+        # Returns None if slug is already taken
+        raise NotImplementedError()
+
+    def rekey(self, limit, cursor=None):
+        # Migrates a batch of entries to the key scheme of the backend,
+        # returning (old key, migrated entry) pairs and the cursor of the next
+        # batch
+        return ([], None)
+
+    def get(self, key):
+        raise NotImplementedError()
+
+    def get_by_slug(self, slug):
+        raise NotImplementedError()
+
+    def get_multi(self, keys):
+        # The entries that still exist, in the order of keys
+        raise NotImplementedError()
+
+    def metadata(self):
+        # (key, slug, title, published, updated, tags, hidden) for every entry
+        raise NotImplementedError()
+
+    def list_visible(self, limit, cursor=None):
+        raise NotImplementedError()
+
+    def list_by_tag(self, tag, limit=None, cursor=None):
+        raise NotImplementedError()
+
+    def list_all(self, limit, cursor=None):
+        raise NotImplementedError()
+
+    def slugs(self):
+        raise NotImplementedError()
+
+    def tag_counts(self, limit):
+        # [(tag, number of visible entries)], most used first
+        raise NotImplementedError()
+
+    def rebuild_tags(self):
+        pass
+
+    def rebuild_summaries(self):
+        pass
+
+    def put(self, entry):
+        self.put_multi([entry])
+
+    def put_multi(self, entries, touch=True):
+        raise NotImplementedError()
+
+    def delete(self, entry):
+        raise NotImplementedError()
+
+
+class DatastoreStorage(Storage):
+    # Tag listings and counts come from one tag_model record per tag, keyed by
+    # the tag, holding the keys of its visible entries in published order.
+    # The records are kept up to date in a transaction per tag whenever an
+    # entry is saved or deleted. Likewise every entry has a summary_model
+    # record, keyed by the entry's key, with everything but the body so
+    # metadata doesn't have to read the bodies of every entry
+    def __init__(self, model, tag_model, summary_model):
+        self.model = model
+        self.tag_model = tag_model
+        self.summary_model = summary_model
+
+    def convert(self, fields):
+        if "tags" in fields:
+            fields["tags"] = [db.Category(tag) for tag in fields["tags"]]
+        return fields
+
+    def new(self, **fields):
+        return self.model(**self.convert(fields))
+
+    def update(self, entry, **fields):
+        for (name, value) in self.convert(fields).iteritems():
+            setattr(entry, name, value)
+
+    def get(self, key):
+        try:
+            return self.model.get(key)
+        except (db.BadKeyError, db.BadArgumentError):
+            return None
+
+    def insert(self, slug, fields):
+        fields = self.convert(dict(fields))
+
+        def insert():
+            if self.model.get_by_key_name(slug):
+                return None
+            entry = self.model(key_name=slug, slug=slug, **fields)
+            entry.put()
+            return entry
+        # Entries from before they were keyed by slug can only be found with a
+        # query, which can't run inside the transaction
+        if db.Query(self.model, keys_only=True).filter("slug =", slug).get():
+            return None
+        entry = db.run_in_transaction(insert)
+        if entry:
+            self.update_tags(entry, [])
+            db.put(self.summarize([entry]))
+        return entry
+
+    def get_by_slug(self, slug):
+        # Entries are keyed by their slug. The query is only for entries that
+        # rekey hasn't migrated yet
+        return self.model.get_by_key_name(slug) or \
+            db.Query(self.model).filter("slug =", slug).get()
+
+    def get_multi(self, keys):
+        try:
+            return [entry for entry in self.model.get(keys) if entry]
+        except (db.BadKeyError, db.BadArgumentError):
+            return []
+
+    def summarize(self, entries):
+        return [self.summary_model(key_name=str(entry.key()),
+                    slug=entry.slug, title=entry.title,
+                    published=entry.published, updated=entry.updated,
+                    tags=list(entry.tags), hidden=entry.hidden)
+                for entry in entries]
+
+    def metadata(self):
+        rows = [(summary.key().name(), summary.slug, summary.title,
+                 summary.published, summary.updated, summary.tags,
+                 summary.hidden)
+                for summary in db.Query(self.summary_model).run(
+                    batch_size=1000)]
+        if rows:
+            return rows
+        # Only until rebuild_summaries has run
+        return [metadata(entry)
+                for entry in db.Query(self.model).run(batch_size=1000)]
+
+    def rekey(self, limit, cursor=None):
+        (entries, cursor) = self.list_all(limit, cursor)
+        migrated = []
+        for entry in entries:
+            # Duplicate slugs from before creating was atomic stay where they
+            # are, get_by_slug can still find them
+            if entry.key().name() or self.model.get_by_key_name(entry.slug):
+                continue
+            fields = dict((name, getattr(entry, name))
+                          for name in self.model.properties())
+            copy = self.model(key_name=entry.slug, **fields)
+            with self.model.updated.untouched():
+                copy.put()
+            self.delete(entry)
+            self.update_tags(copy, [])
+            db.put(self.summarize([copy]))
+            migrated.append((str(entry.key()), copy))
+        return (migrated, cursor)
+
+    def fetch(self, q, limit, cursor):
+        # A cursor from another query only fails once the query runs
+        try:
+            if cursor:
+                q.with_cursor(cursor)
+            if limit is None:
+                return (list(q), None)
+            entries = q.fetch(limit=limit)
+        except (db.BadRequestError, db.BadValueError):
+            if not cursor:
+                raise
+            raise BadCursorError(cursor)
+        return (entries, q.cursor() if len(entries) == limit else None)
+
+    def list_visible(self, limit, cursor=None):
+        q = db.Query(self.model).filter("hidden =", False).order("-published")
+        return self.fetch(q, limit, cursor)
+
+    def list_by_tag(self, tag, limit=None, cursor=None):
+        record = self.tag_model.get_by_key_name(tag)
+        if record is None:
+            # Only until rebuild_tags has run, afterwards tags that lost all
+            # their entries still have an (empty) record
+            q = db.Query(self.model).filter("hidden =", False).filter(
+                "tags =", tag).order("-published")
+            return self.fetch(q, limit, cursor)
+        keys = record.entry_keys[::-1]
+        try:
+            offset = int(cursor) if cursor else 0
+        except ValueError:
+            raise BadCursorError(cursor)
+        if offset < 0:
+            raise BadCursorError(cursor)
+        end = offset + limit if limit is not None else len(keys)
+        entries = [entry for entry in db.get(keys[offset:end]) if entry]
+        return (entries, str(end) if end < len(keys) else None)
+
+    def list_all(self, limit, cursor=None):
+        return self.fetch(db.Query(self.model), limit, cursor)
+
+    def slugs(self):
+        return [entry.slug for entry in db.Query(self.model,
+            projection=("slug",)).run(batch_size=1000)]
+
+    def tag_counts(self, limit):
+        q = db.Query(self.tag_model).filter("count >", 0).order("-count")
+        return [(record.key().name(), record.count)
+                for record in q.fetch(limit=limit)]
+
+    def update_tag(self, tag, key, published):
+        # Removes key from the tag and adds it back in published order when
+        # published is given
+        def update():
+            record = self.tag_model.get_by_key_name(tag) or \
+                self.tag_model(key_name=tag)
+            keys = list(record.entry_keys)
+            dates = list(record.published)
+            if key in keys:
+                index = keys.index(key)
+                del keys[index]
+                del dates[index]
+            if published:
+                index = bisect.bisect(dates, published)
+                keys.insert(index, key)
+                dates.insert(index, published)
+            record.entry_keys = keys
+            record.published = dates
+            record.count = len(keys)
+            record.put()
+        db.run_in_transaction(update)
+
+    def rebuild_tags(self):
+        records = {}
+        for entry in db.Query(self.model).filter("hidden =", False).order(
+                "-published").run(batch_size=1000):
+            for tag in entry.tags:
+                record = records.setdefault(tag,
+                    self.tag_model(key_name=tag, entry_keys=[], published=[]))
+                record.entry_keys.insert(0, entry.key())
+                record.published.insert(0, entry.published)
+        # Tags no visible entry uses any more are emptied rather than deleted
+        for record in db.Query(self.tag_model):
+            if record.key().name() not in records:
+                record.entry_keys = []
+                record.published = []
+                records[record.key().name()] = record
+        for record in records.itervalues():
+            record.count = len(record.entry_keys)
+        db.put(records.values())
+
+    def rebuild_summaries(self):
+        entries = list(db.Query(self.model).run(batch_size=1000))
+        keys = set(str(entry.key()) for entry in entries)
+        db.put(self.summarize(entries))
+        db.delete([key for key in db.Query(self.summary_model, keys_only=True)
+                   if key.name() not in keys])
+
+    def put_multi(self, entries, touch=True):
+        saved = [entry.key() for entry in entries if entry.is_saved()]
+        old_tags = dict((entry.key(), entry.tags)
+                        for entry in db.get(saved) if entry)
+        # updated is auto_now, except in untouched()
+        if touch:
+            db.put(entries)
+        else:
+            with self.model.updated.untouched():
+                db.put(entries)
+        db.put(self.summarize(entries))
+        for entry in entries:
+            self.update_tags(entry, old_tags.get(entry.key(), []))
+
+    def update_tags(self, entry, old_tags):
+        published = None if entry.hidden else entry.published
+        for tag in set(entry.tags) | set(old_tags):
+            self.update_tag(tag, entry.key(),
+                            published if tag in entry.tags else None)
+
+    def delete(self, entry):
+        summary = db.Key.from_path(self.summary_model.kind(), str(entry.key()))
+        db.delete([entry.key(), summary])
+        for tag in set(entry.tags):
+            self.update_tag(tag, entry.key(), None)
+
+
+class Author(object):
+    def __init__(self, nickname):
+        self._nickname = nickname
+
+    def nickname(self):
+        return self._nickname
+
+
+class SQLiteEntry(object):
+    def __init__(self, id=None, author=None, title=None, slug=None, body=None,
+                 published=None, updated=None, tags=(), hidden=False,
+                 thumbnails=None, excerpt=None, word_count=None,
+                 reading_time=None):
+        self.id = id
+        self.author = author
+        self.title = title
+        self.slug = slug
+        self.body = body
+        self.published = published
+        self.updated = updated
+        self.tags = list(tags)
+        self.hidden = hidden
+        self.thumbnails = thumbnails
+        self.excerpt = excerpt
+        self.word_count = word_count
+        self.reading_time = reading_time
+
+    def key(self):
+        return str(self.id)
+
+
+class SQLiteStorage(Storage):
+    # Keeps entries in a local SQLite database so the blog can run, and be
+    # benchmarked, away from App Engine. The two list indexes mirror the
+    # composite indexes in index.yaml; tags live in their own table with hidden
+    # and published copied in so tag listings are served from one index
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            author TEXT,
+            title TEXT NOT NULL,
+            slug TEXT NOT NULL,
+            body TEXT NOT NULL,
+            published TEXT NOT NULL,
+            updated TEXT NOT NULL,
+            hidden INTEGER NOT NULL DEFAULT 0,
+            thumbnails TEXT,
+            excerpt TEXT,
+            word_count INTEGER,
+            reading_time INTEGER
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS entries_slug ON entries (slug);
+        CREATE INDEX IF NOT EXISTS entries_updated ON entries (updated);
+        CREATE INDEX IF NOT EXISTS entries_hidden_published
+            ON entries (hidden, published DESC, id DESC);
+        CREATE TABLE IF NOT EXISTS entry_tags (
+            entry_id INTEGER NOT NULL,
+            tag TEXT NOT NULL,
+            hidden INTEGER NOT NULL,
+            published TEXT NOT NULL,
+            PRIMARY KEY (entry_id, tag)
+        );
+        CREATE INDEX IF NOT EXISTS entry_tags_hidden_tag_published
+            ON entry_tags (hidden, tag, published DESC, entry_id DESC);
+    """
+
+    # Columns added since the table was first created, added to older
+    # databases when they are opened
+    ADDED_COLUMNS = (
+        ("excerpt", "TEXT"),
+        ("word_count", "INTEGER"),
+        ("reading_time", "INTEGER"),
+    )
+
+    COLUMNS = ("id, author, title, slug, body, published, updated, hidden, "
+               "thumbnails, excerpt, word_count, reading_time")
+
+    DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        # Set up in a single transaction taking the write lock up front, so
+        # processes opening the same new database at once (e.g. the workers
+        # of prefork.py) take turns. Autocommit mode keeps sqlite3 from
+        # committing it early
+        connection = sqlite3.connect(path, isolation_level=None)
+        connection.execute("BEGIN IMMEDIATE")
+        for statement in self.SCHEMA.split(";"):
+            if statement.strip():
+                connection.execute(statement)
+        existing = set(row[1] for row in
+                       connection.execute("PRAGMA table_info(entries)"))
+        for (name, type) in self.ADDED_COLUMNS:
+            if name not in existing:
+                connection.execute(
+                    "ALTER TABLE entries ADD COLUMN %s %s" % (name, type))
+        connection.execute("COMMIT")
+        connection.close()
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path)
+            self.local.connection = connection
+        return connection
+
+    def format_date(self, value):
+        return value.strftime(self.DATE_FORMAT)
+
+    def parse_date(self, value):
+        return datetime.datetime.strptime(value, self.DATE_FORMAT)
+
+    def load(self, rows):
+        entries = []
+        for row in rows:
+            entries.append(SQLiteEntry(
+                id=row[0],
+                author=Author(row[1]) if row[1] is not None else None,
+                title=row[2],
+                slug=row[3],
+                body=row[4],
+                published=self.parse_date(row[5]),
+                updated=self.parse_date(row[6]),
+                hidden=bool(row[7]),
+                thumbnails=json.loads(row[8]) if row[8] else None,
+                excerpt=row[9],
+                word_count=row[10],
+                reading_time=row[11],
+            ))
+        if entries:
+            by_id = dict((entry.id, entry) for entry in entries)
+            ids = ",".join(str(id) for id in by_id)
+            for (entry_id, tag) in self.connection.execute(
+                    "SELECT entry_id, tag FROM entry_tags WHERE entry_id IN "
+                    "(%s) ORDER BY tag" % ids):
+                by_id[entry_id].tags.append(tag)
+        return entries
+
+    def parse_cursor(self, cursor):
+        try:
+            (published, id) = cursor.rsplit(",", 1)
+            return (self.format_date(self.parse_date(published)), int(id))
+        except (AttributeError, TypeError, ValueError):
+            raise BadCursorError(cursor)
+
+    def page(self, sql, args, order, limit, cursor):
+        # Keyset pagination on (published, id), the cursor being the last row
+        # of the previous page
+        position = self.parse_cursor(cursor) if cursor else None
+        if position:
+            sql += " AND (%s < ? OR (%s = ? AND %s < ?))" % (
+                order[0], order[0], order[1])
+            args = args + [position[0], position[0], position[1]]
+        sql += " ORDER BY %s DESC, %s DESC" % order
+        if limit is not None:
+            sql += " LIMIT %d" % limit
+        entries = self.load(self.connection.execute(sql, args))
+        if limit is None or len(entries) < limit:
+            return (entries, None)
+        last = entries[-1]
+        return (entries, "%s,%d" % (self.format_date(last.published), last.id))
+
+    def new(self, **fields):
+        nickname = fields.pop("author", None)
+        if nickname is not None and not isinstance(nickname, basestring):
+            nickname = nickname.nickname()
+        return SQLiteEntry(
+            author=Author(nickname) if nickname is not None else None,
+            **fields)
+
+    def update(self, entry, **fields):
+        for (name, value) in fields.iteritems():
+            setattr(entry, name, value)
+
+    def insert(self, slug, fields):
+        # The unique index on slug does the reserving
+        entry = self.new(slug=slug, **fields)
+        try:
+            self.put(entry)
+        except sqlite3.IntegrityError:
+            return None
+        return entry
+
+    def get(self, key):
+        try:
+            id = int(key)
+        except (TypeError, ValueError):
+            return None
+        entries = self.load(self.connection.execute(
+            "SELECT %s FROM entries WHERE id = ?" % self.COLUMNS, (id,)))
+        return entries[0] if entries else None
+
+    def get_by_slug(self, slug):
+        entries = self.load(self.connection.execute(
+            "SELECT %s FROM entries WHERE slug = ?" % self.COLUMNS, (slug,)))
+        return entries[0] if entries else None
+
+    def get_multi(self, keys):
+        ids = []
+        for key in keys:
+            try:
+                ids.append(int(key))
+            except (TypeError, ValueError):
+                pass
+        if not ids:
+            return []
+        by_id = dict((entry.id, entry) for entry in self.load(
+            self.connection.execute("SELECT %s FROM entries WHERE id IN (%s)" %
+                (self.COLUMNS, ",".join(str(id) for id in ids)))))
+        return [by_id[id] for id in ids if id in by_id]
+
+    def metadata(self):
+        tags = {}
+        for (entry_id, tag) in self.connection.execute(
+                "SELECT entry_id, tag FROM entry_tags ORDER BY tag"):
+            tags.setdefault(entry_id, []).append(tag)
+        return [(str(row[0]), row[1], row[2], self.parse_date(row[3]),
+                 self.parse_date(row[4]), tags.get(row[0], []), bool(row[5]))
+                for row in self.connection.execute(
+                    "SELECT id, slug, title, published, updated, hidden "
+                    "FROM entries")]
+
+    def list_visible(self, limit, cursor=None):
+        return self.page("SELECT %s FROM entries WHERE hidden = 0" %
+            self.COLUMNS, [], ("published", "id"), limit, cursor)
+
+    def list_by_tag(self, tag, limit=None, cursor=None):
+        columns = ", ".join("e." + column.strip()
+                            for column in self.COLUMNS.split(","))
+        return self.page("SELECT %s FROM entry_tags t JOIN entries e ON "
+            "e.id = t.entry_id WHERE t.hidden = 0 AND t.tag = ?" % columns,
+            [tag], ("t.published", "t.entry_id"), limit, cursor)
+
+    def list_all(self, limit, cursor=None):
+        return self.page("SELECT %s FROM entries WHERE 1 = 1" % self.COLUMNS,
+            [], ("published", "id"), limit, cursor)
+
+    def slugs(self):
+        return [row[0] for row in
+                self.connection.execute("SELECT slug FROM entries")]
+
+    def tag_counts(self, limit):
+        return list(self.connection.execute(
+            "SELECT tag, COUNT(*) FROM entry_tags WHERE hidden = 0 "
+            "GROUP BY tag ORDER BY 2 DESC, tag LIMIT ?", (limit,)))
+
+    def put_multi(self, entries, touch=True):
+        now = datetime.datetime.utcnow()
+        with self.connection as connection:
+            for entry in entries:
+                if entry.published is None:
+                    entry.published = now
+                if touch or entry.updated is None:
+                    entry.updated = now
+                row = (
+                    entry.author.nickname() if entry.author else None,
+                    entry.title,
+                    entry.slug,
+                    entry.body,
+                    self.format_date(entry.published),
+                    self.format_date(entry.updated),
+                    int(bool(entry.hidden)),
+                    json.dumps(entry.thumbnails, separators=(",", ":"))
+                        if entry.thumbnails is not None else None,
+                    entry.excerpt,
+                    entry.word_count,
+                    entry.reading_time,
+                )
+                if entry.id is None:
+                    entry.id = connection.execute(
+                        "INSERT INTO entries (author, title, slug, body, "
+                        "published, updated, hidden, thumbnails, excerpt, "
+                        "word_count, reading_time) VALUES "
+                        "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row).lastrowid
+                else:
+                    connection.execute(
+                        "UPDATE entries SET author = ?, title = ?, slug = ?, "
+                        "body = ?, published = ?, updated = ?, hidden = ?, "
+                        "thumbnails = ?, excerpt = ?, word_count = ?, "
+                        "reading_time = ? WHERE id = ?", row + (entry.id,))
+                connection.execute(
+                    "DELETE FROM entry_tags WHERE entry_id = ?", (entry.id,))
+                connection.executemany(
+                    "INSERT INTO entry_tags (entry_id, tag, hidden, published) "
+                    "VALUES (?, ?, ?, ?)", [(entry.id, tag, row[6], row[4])
+                                            for tag in set(entry.tags)])
+
+    def delete(self, entry):
+        with self.connection as connection:
+            connection.execute(
+                "DELETE FROM entry_tags WHERE entry_id = ?", (entry.id,))
+            connection.execute("DELETE FROM entries WHERE id = ?", (entry.id,))
+
+
+def from_url(url, model=None, tag_model=None, summary_model=None):
+    # BLOG_STORAGE is either unset (the datastore) or sqlite:<path>
+    if not url or url == "datastore":
+        return DatastoreStorage(model, tag_model, summary_model)
+    if url.startswith("sqlite:"):
+        return SQLiteStorage(os.path.expanduser(url[len("sqlite:"):]))
+    raise ValueError("Unknown storage %r" % url)